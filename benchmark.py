@@ -0,0 +1,178 @@
+import io
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import subprocess
+import pylightxl as xl
+from contextlib import redirect_stdout
+from pgim import extractPages, parseInvoicePage, parseTimeDetailPage, joinTimeDetailPages, pairData, writeMergedPairs, loadPropertyNameIndex, statisticalAnalysis
+
+words = ['Plaza', 'Tower', 'Center', 'Park', 'Commons', 'Square', 'Heights', 'Crossing', 'Landing', 'Pointe', 'Marketplace', 'Business', 'Industrial', 'Gateway', 'Harbor', 'Meadows']
+
+def escapePdfText(text):
+    return text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+def writeSyntheticPdf(fname, pages):
+    # Minimal uncompressed PDF, one text line per ' operator so PyPDF2's extractText gives back
+    # exactly the lines of each page separated by '\n'
+    objects = [b'<< /Type /Catalog /Pages 2 0 R >>']
+    kids = ' '.join(str(4 + 2 * pageNum) + ' 0 R' for pageNum in range(len(pages)))
+    objects.append(('<< /Type /Pages /Kids [' + kids + '] /Count ' + str(len(pages)) + ' >>').encode())
+    objects.append(b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>')
+    for pageNum, lines in enumerate(pages):
+        objects.append(('<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Resources << /Font << /F1 3 0 R >> >> /Contents ' + str(5 + 2 * pageNum) + ' 0 R >>').encode())
+        content = ('BT /F1 10 Tf 12 TL 40 760 Td\n' + ''.join('(' + escapePdfText(line) + ") '\n" for line in lines) + 'ET').encode('latin-1')
+        objects.append(b'<< /Length ' + str(len(content)).encode() + b' >>\nstream\n' + content + b'\nendstream')
+
+    pdf = bytearray(b'%PDF-1.4\n')
+    offsets = []
+    for objNum, obj in enumerate(objects):
+        offsets.append(len(pdf))
+        pdf += str(objNum + 1).encode() + b' 0 obj\n' + obj + b'\nendobj\n'
+    xrefOffset = len(pdf)
+    pdf += b'xref\n0 ' + str(len(objects) + 1).encode() + b'\n0000000000 65535 f \n'
+    for offset in offsets:
+        pdf += ('%010d 00000 n \n' % offset).encode()
+    pdf += b'trailer\n<< /Size ' + str(len(objects) + 1).encode() + b' /Root 1 0 R >>\nstartxref\n' + str(xrefOffset).encode() + b'\n%%EOF\n'
+    with open(fname, 'wb') as hPdf:
+        hPdf.write(pdf)
+
+def timeDetailHeader(projectIdx, projectName, rnd):
+    # covers every project number layout parseTimeDetailPage handles, returns (pNum, header lines)
+    layout = projectIdx % 4
+    if layout == 0:
+        pNum = str(100000 + projectIdx)
+        return pNum, ['PGIM Real Estate:' + pNum + ' ' + projectName, 'Employee Date Hours']
+    pNum = str(1000 + projectIdx) + '.' + str(rnd.randint(10, 99))
+    if layout == 1:
+        # PK name ending in a letter, the last two characters are dropped
+        return pNum, ['PGIM Real Estate:RE PK:' + pNum + ' ' + rnd.choice('ABCDEFGH'), 'Employee Date Hours']
+    if layout == 2:
+        # PK name ending in a space
+        return pNum, ['PGIM Real Estate:RE PK:' + pNum + ' ', 'Employee Date Hours']
+    # PK number split across two lines, the rest of it starts the next line
+    split = rnd.randint(len(pNum) - 3, len(pNum) - 1)
+    return pNum, ['PGIM Real Estate:RE PK:' + pNum[:split], pNum[split:] + ' ' + projectName]
+
+def makeSyntheticBatch(directory, numInvoices, seed=0):
+    rnd = random.Random(seed)
+    invoicePages = []
+    timeDetailPages = []
+    projectNames = []
+    for projectIdx in range(numInvoices):
+        projectName = rnd.choice(words) + ' ' + rnd.choice(words) + ' ' + str(projectIdx)
+        projectNames.append(projectName)
+        pNum, header = timeDetailHeader(projectIdx, projectName, rnd)
+        invoicePages.append(['Invoice', 'Invoice No.', 'INV' + str(500000 + projectIdx), 'Project No.', pNum + ' ' + projectName, 'PGIM Real Estate', 'am' + str(projectIdx % 25) + '@example.com', 'Amount Due'])
+        timeDetailPages.append(['Time Detail', 'Notes'] + header + ['Hours ' + str(rnd.randint(1, 40))])
+        for continuation in range(rnd.choice([0, 0, 1, 1, 2, 4])):
+            timeDetailPages.append(['Time Detail', 'Notes', 'Employee Date Hours', 'Hours ' + str(rnd.randint(1, 40))])
+
+    invoiceFname = os.path.join(directory, 'invoices.pdf')
+    timeDetailFname = os.path.join(directory, 'time_detail.pdf')
+    writeSyntheticPdf(invoiceFname, invoicePages)
+    writeSyntheticPdf(timeDetailFname, timeDetailPages)
+    return invoiceFname, timeDetailFname, len(timeDetailPages), projectNames
+
+def makeAssetAssignments(fname, projectNames, numRows, seed=0):
+    # property names in column 3 from row 3, roughly half of them spelled a bit differently from
+    # the invoice and the rest unrelated properties
+    rnd = random.Random(seed)
+    db = xl.Database()
+    sheets = ['Office', 'Industrial']
+    for wsName in sheets:
+        db.add_ws(ws=wsName)
+        db.ws(ws=wsName).update_index(row=1, col=1, val='Asset Assignments')
+        for col, title in enumerate(['Asset', 'Manager', 'Property Name']):
+            db.ws(ws=wsName).update_index(row=2, col=col + 1, val=title)
+
+    for rowIdx in range(numRows):
+        if rowIdx < len(projectNames) and rowIdx % 2 == 0:
+            name = projectNames[rowIdx]
+            if rowIdx % 3 == 0:
+                name = name.upper()
+            elif rowIdx % 3 == 1:
+                name = name.replace(' ', '  ', 1)
+        else:
+            name = rnd.choice(words) + ' ' + rnd.choice(words) + ' ' + str(rnd.randint(0, numRows * 2))
+        wsName = sheets[rowIdx % 2]
+        row = rowIdx // 2 + 3
+        db.ws(ws=wsName).update_index(row=row, col=1, val='A' + str(rowIdx))
+        db.ws(ws=wsName).update_index(row=row, col=2, val='am' + str(rowIdx % 25) + '@example.com')
+        db.ws(ws=wsName).update_index(row=row, col=3, val=name)
+    xl.writexl(db=db, fn=fname)
+
+def timeStage(results, stage, items, func):
+    with redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        value = func()
+        seconds = time.perf_counter() - start
+    results[stage] = {'seconds': seconds, 'items': items, 'itemsPerSecond': items / seconds if seconds > 0 else None}
+    return value
+
+def benchmarkSize(size, processes, workDir):
+    invoiceFname, timeDetailFname, timeDetailPageCount, projectNames = makeSyntheticBatch(workDir, size)
+    assetAssignmentsFname = os.path.join(workDir, 'asset_assignments.xlsx')
+    makeAssetAssignments(assetAssignmentsFname, projectNames, size)
+    outputDir = os.path.join(workDir, 'output')
+    os.mkdir(outputDir)
+
+    results = {}
+    invoices = timeStage(results, 'extractInvoices', size, lambda: extractPages(invoiceFname, parseInvoicePage, processes))
+    timeDetail = timeStage(results, 'extractTimeDetail', timeDetailPageCount, lambda: joinTimeDetailPages(extractPages(timeDetailFname, parseTimeDetailPage, processes)))
+    pairedData = timeStage(results, 'pairData', len(invoices), lambda: pairData(invoices, timeDetail).pairs)
+    timeStage(results, 'mergePairs', len(pairedData), lambda: writeMergedPairs(pairedData, invoiceFname, timeDetailFname, outputDir, processes))
+    index = timeStage(results, 'loadAssetAssignments', size, lambda: loadPropertyNameIndex(assetAssignmentsFname))
+    timeStage(results, 'statisticalAnalysis', len(pairedData), lambda: statisticalAnalysis(index, pairedData))
+    return results
+
+def currentCommit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ''
+
+def runBenchmarks(sizes, processes):
+    report = {'commit': currentCommit(), 'python': platform.python_version(), 'platform': platform.platform(), 'processes': processes, 'sizes': {}}
+    for size in sizes:
+        print('Benchmarking ' + str(size) + ' invoices...')
+        with tempfile.TemporaryDirectory() as workDir:
+            report['sizes'][str(size)] = benchmarkSize(size, processes, workDir)
+        for stage, result in report['sizes'][str(size)].items():
+            print('  ' + stage.ljust(22) + ('%.3f' % result['seconds']).rjust(10) + 's')
+    return report
+
+def compareResults(baselineFname, currentFname):
+    with open(baselineFname) as hBaseline, open(currentFname) as hCurrent:
+        baseline = json.load(hBaseline)
+        current = json.load(hCurrent)
+    print('Stage timings ' + baseline.get('commit', baselineFname) + ' -> ' + current.get('commit', currentFname))
+    for size, stages in current['sizes'].items():
+        for stage, result in stages.items():
+            before = baseline['sizes'].get(size, {}).get(stage)
+            line = size.rjust(6) + ' ' + stage.ljust(22) + ('%.3f' % result['seconds']).rjust(10) + 's'
+            if before is not None and result['seconds'] > 0:
+                line += ('%.3f' % before['seconds']).rjust(10) + 's' + ('%.2fx' % (before['seconds'] / result['seconds'])).rjust(9)
+            print(line)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Invoice automator benchmarks on synthetic invoices, time details and asset assignments')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000], help='Number of invoices (and asset assignment rows) to benchmark')
+    parser.add_argument('-j', '--processes', type=int, default=1, help='Worker processes used to parse and merge PDF pages')
+    parser.add_argument('-o', '--output', type=str, default='bench_results.json', help='Path to write the results JSON')
+    parser.add_argument('--compare', type=str, nargs=2, metavar=('BASELINE', 'CURRENT'), help='Compare two results files instead of running')
+    args = parser.parse_args()
+
+    if args.compare:
+        compareResults(*args.compare)
+        sys.exit(0)
+
+    report = runBenchmarks(args.sizes, args.processes)
+    with open(args.output, 'w') as hOutput:
+        json.dump(report, hOutput, indent=2)
+    print('Results written to ' + args.output)
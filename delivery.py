@@ -0,0 +1,202 @@
+import io
+import os
+import time
+import queue
+import sqlite3
+import smtplib
+import zipfile
+import threading
+from typing import List
+from dataclasses import dataclass, field
+from email.message import EmailMessage
+from email.utils import make_msgid, formatdate
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+@dataclass
+class Delivery:
+    recipient: str
+    paths: List[str] = field(default_factory=list)
+    size: int = 0
+
+class SentLedger:
+    # Which merged PDFs, by output file name, have been sent to which recipient. A message's files
+    # are recorded as soon as the server accepts it, so a rerun, or a run after one that stopped
+    # part way, only sends what each recipient hasn't had yet.
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS sent (recipient TEXT, fname TEXT, sentAt REAL, PRIMARY KEY (recipient, fname))')
+        self.db.commit()
+
+    def isSent(self, recipient, fname):
+        return self.db.execute('SELECT 1 FROM sent WHERE recipient = ? AND fname = ?', (recipient, fname)).fetchone() is not None
+
+    def record(self, recipient, fnames):
+        self.db.executemany('INSERT OR REPLACE INTO sent VALUES (?, ?, ?)', ((recipient, fname, time.time()) for fname in fnames))
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+class SmtpPool:
+    # Connections to one SMTP server shared by the sending threads. Each send takes an idle
+    # connection, or opens one, and puts it back afterwards, a connection that fails is dropped.
+    # With one thread per connection there are never more than size open. Sends are spaced out to
+    # at most rate messages a second across the whole pool. Once the server turns down the login no
+    # more connections are opened, every later send fails with the same error straight away.
+    def __init__(self, host, port=25, size=4, user=None, password=None, starttls=False, rate=None, timeout=60):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.user = user
+        self.password = password
+        self.starttls = starttls
+        self.rate = rate
+        self.timeout = timeout
+        self.idle = queue.LifoQueue()
+        self.throttleLock = threading.Lock()
+        self.nextSend = 0.0
+        self.loginRefused = None
+        self.connectLock = threading.Lock()
+
+    def connect(self):
+        # one connection is opened at a time, so a refused login is only ever tried once
+        with self.connectLock:
+            if self.loginRefused is not None:
+                raise smtplib.SMTPAuthenticationError(*self.loginRefused)
+            smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+            try:
+                if self.starttls:
+                    smtp.starttls()
+                if self.user is not None:
+                    smtp.login(self.user, self.password)
+            except smtplib.SMTPAuthenticationError as e:
+                self.loginRefused = (e.smtp_code, e.smtp_error)
+                smtp.close()
+                raise
+            except:
+                smtp.close()
+                raise
+            return smtp
+
+    def throttle(self):
+        if not self.rate:
+            return
+        with self.throttleLock:
+            now = time.monotonic()
+            wait = self.nextSend - now
+            self.nextSend = max(now, self.nextSend) + 1 / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+    def send(self, message):
+        self.throttle()
+        try:
+            smtp = self.idle.get_nowait()
+        except queue.Empty:
+            smtp = self.connect()
+        try:
+            smtp.send_message(message)
+        except smtplib.SMTPRecipientsRefused:
+            # the connection is fine, the server just won't take this recipient
+            self.idle.put(smtp)
+            raise
+        except:
+            smtp.close()
+            raise
+        self.idle.put(smtp)
+
+    def close(self):
+        while not self.idle.empty():
+            smtp = self.idle.get_nowait()
+            try:
+                smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                smtp.close()
+
+def isTransient(e):
+    # Dropped connections, failed connects, 4xx replies and network errors are worth another try.
+    # Other SMTP errors, 5xx replies or a server without STARTTLS say, fail the same way again.
+    # SMTPException is an OSError too, so it has to be ruled out before the network errors.
+    if isinstance(e, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError)):
+        return True
+    if isinstance(e, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, msg in e.recipients.values())
+    if isinstance(e, smtplib.SMTPResponseException):
+        return 400 <= e.smtp_code < 500
+    if isinstance(e, smtplib.SMTPException):
+        return False
+    return isinstance(e, OSError)
+
+def buildMessage(sender, delivery, bundle=False):
+    count = str(len(delivery.paths))
+    message = EmailMessage()
+    message['From'] = sender
+    message['To'] = delivery.recipient
+    message['Date'] = formatdate(localtime=True)
+    message['Message-ID'] = make_msgid()
+    message['Subject'] = 'Invoices and time detail (' + count + ')'
+    message.set_content('Attached are ' + count + ' merged invoice and time detail PDFs:\n\n' + '\n'.join(os.path.basename(path) for path in delivery.paths) + '\n')
+    if bundle:
+        bundled = io.BytesIO()
+        with zipfile.ZipFile(bundled, 'w', zipfile.ZIP_DEFLATED) as hZip:
+            for path in delivery.paths:
+                hZip.write(path, os.path.basename(path))
+        message.add_attachment(bundled.getvalue(), maintype='application', subtype='zip', filename='invoices.zip')
+    else:
+        for path in delivery.paths:
+            with open(path, 'rb') as hPdf:
+                message.add_attachment(hPdf.read(), maintype='application', subtype='pdf', filename=os.path.basename(path))
+    return message
+
+def sendDelivery(pool, sender, delivery, bundle=False, attempts=4, backoff=2.0):
+    # the message is built in the sending thread so only the messages in flight are held in memory
+    message = buildMessage(sender, delivery, bundle)
+    for attempt in range(attempts):
+        try:
+            pool.send(message)
+            return
+        except (smtplib.SMTPException, OSError) as e:
+            if attempt == attempts - 1 or not isTransient(e):
+                raise
+        time.sleep(backoff * 2 ** attempt)
+
+def planDeliveries(outputs, ledger, maxBytes=20 << 20):
+    # outputs is [(recipient, path)]. Returns (deliveries, outputs already sent), one Delivery per
+    # recipient of the paths the ledger doesn't have as sent to them, split in more than one when
+    # the attachments come to over maxBytes since servers turn away messages that are too large.
+    byRecipient = {}
+    alreadySent = 0
+    for recipient, path in outputs:
+        if ledger.isSent(recipient, os.path.basename(path)):
+            alreadySent += 1
+        else:
+            byRecipient.setdefault(recipient, []).append(path)
+
+    deliveries = []
+    for recipient, paths in sorted(byRecipient.items()):
+        delivery = None
+        for path in sorted(paths):
+            size = os.path.getsize(path)
+            if delivery is None or (len(delivery.paths) > 0 and delivery.size + size > maxBytes):
+                delivery = Delivery(recipient)
+                deliveries.append(delivery)
+            delivery.paths.append(path)
+            delivery.size += size
+    return deliveries, alreadySent
+
+def deliver(deliveries, pool, sender, ledger, bundle=False, progress=None):
+    # Sends every delivery, pool.size at a time, recording each in ledger once it's accepted.
+    # Returns [(delivery, error)] for those that still failed after their retries.
+    failures = []
+    with ThreadPoolExecutor(max_workers=pool.size) as executor:
+        sending = {executor.submit(sendDelivery, pool, sender, delivery, bundle): delivery for delivery in deliveries}
+        for done, future in enumerate(as_completed(sending)):
+            delivery = sending[future]
+            try:
+                future.result()
+                ledger.record(delivery.recipient, [os.path.basename(path) for path in delivery.paths])
+            except (smtplib.SMTPException, OSError) as e:
+                failures.append((delivery, str(e)))
+            if progress:
+                progress(done + 1, len(deliveries))
+    return failures
@@ -0,0 +1,88 @@
+import os
+import sys
+import json
+import time
+import cProfile
+from contextlib import contextmanager
+try:
+    import resource
+except ImportError:
+    # Windows has no getrusage, peak memory is left out there
+    resource = None
+
+def peakRss(who):
+    # the largest resident set size so far in bytes, Linux reports it in KB and macOS in bytes
+    maxRss = resource.getrusage(who).ru_maxrss
+    return maxRss if sys.platform == 'darwin' else maxRss * 1024
+
+class StageMetrics:
+    def __init__(self, name):
+        self.name = name
+        self.seconds = 0.0
+        self.items = 0
+        self.peakMemory = None
+        self.peakWorkerMemory = None
+        self.itemTimes = []
+
+    def item(self, itemId, seconds=None):
+        # seconds is left out for items that didn't need any work, like pages read from the cache
+        self.items += 1
+        if seconds is not None:
+            self.itemTimes.append((itemId, seconds))
+
+    def summary(self):
+        result = {
+            'name': self.name,
+            'seconds': self.seconds,
+            'items': self.items,
+            'itemsPerSecond': self.items / self.seconds if self.seconds > 0 else None,
+            'peakMemoryBytes': self.peakMemory,
+            'peakWorkerMemoryBytes': self.peakWorkerMemory,
+        }
+        if len(self.itemTimes) > 0:
+            times = sorted(seconds for itemId, seconds in self.itemTimes)
+            median = times[len(times) // 2]
+            result['itemSeconds'] = {'median': median, 'p95': times[int(len(times) * 0.95)], 'max': times[len(times) - 1]}
+            # anything over 5x the median item, slowest first
+            slowItems = sorted((itemTime for itemTime in self.itemTimes if itemTime[1] > 5 * median), key=lambda itemTime: itemTime[1], reverse=True)
+            result['slowItems'] = [{'item': itemId, 'seconds': seconds} for itemId, seconds in slowItems[:20]]
+        return result
+
+class Metrics:
+    # Per stage wall time, item throughput and slow items, plus peak memory when trackMemory is set
+    # and a cProfile dump per stage in profileDir when it's given. Peak memory is the OS's high
+    # water mark of resident memory at the end of each stage, for this process and for the largest
+    # pool worker that has exited, so it never goes down from one stage to the next and costs
+    # nothing while the stage runs. Profiles only cover this process, not pool workers.
+    def __init__(self, trackMemory=False, profileDir=None):
+        self.trackMemory = trackMemory
+        self.profileDir = profileDir
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name):
+        stage = StageMetrics(name)
+        self.stages.append(stage)
+        profiler = None
+        if self.profileDir is not None:
+            profiler = cProfile.Profile()
+            profiler.enable()
+
+        start = time.perf_counter()
+        try:
+            yield stage
+        finally:
+            stage.seconds = time.perf_counter() - start
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(os.path.join(self.profileDir, str(len(self.stages)) + '_' + name + '.prof'))
+            if self.trackMemory and resource is not None:
+                stage.peakMemory = peakRss(resource.RUSAGE_SELF)
+                stage.peakWorkerMemory = peakRss(resource.RUSAGE_CHILDREN)
+
+    def summary(self):
+        return {'stages': [stage.summary() for stage in self.stages]}
+
+    def export(self, fname):
+        with open(fname, 'w') as hMetrics:
+            json.dump(self.summary(), hMetrics, indent=2)
@@ -0,0 +1,79 @@
+import os
+import json
+from pagecache import fileHash
+
+MANIFEST_VERSION = 1
+
+class OutputManifest:
+    # manifest.json in the output directory, recording for every merged PDF the hashes of the source
+    # PDFs, the pages it was built from and its own checksum. An output whose inputs haven't changed
+    # and whose size and mtime still match what was recorded is left alone, and outputs this run
+    # doesn't produce any more are deleted by finish(). With reuse=False every output is rewritten
+    # but the manifest is still kept up to date.
+    def __init__(self, outputDir, invoiceFname, timeDetailFname, reuse=True):
+        self.outputDir = outputDir
+        self.path = os.path.join(outputDir, 'manifest.json')
+        self.reuse = reuse
+        self.sources = {'invoiceHash': fileHash(invoiceFname), 'timeDetailHash': fileHash(timeDetailFname)}
+        self.entries = {}
+        self.seen = set()
+        self.removed = []
+        self.changed = False
+        if os.path.isfile(self.path):
+            try:
+                with open(self.path) as hManifest:
+                    manifest = json.load(hManifest)
+                if manifest.get('version') == MANIFEST_VERSION:
+                    self.entries = manifest['outputs']
+            except ValueError:
+                print('Ignoring unreadable output manifest ' + self.path)
+
+    def inputs(self, invoicePage, timeDetailPages):
+        return dict(self.sources, invoicePage=invoicePage, timeDetailPages=list(timeDetailPages))
+
+    def isCurrent(self, fname, invoicePage, timeDetailPages):
+        self.seen.add(fname)
+        entry = self.entries.get(fname)
+        if not self.reuse or entry is None or entry['inputs'] != self.inputs(invoicePage, timeDetailPages):
+            return False
+        try:
+            stat = os.stat(os.path.join(self.outputDir, fname))
+        except OSError:
+            return False
+        return stat.st_size == entry['size'] and stat.st_mtime_ns == entry['mtime']
+
+    def record(self, fname, invoicePage, timeDetailPages):
+        path = os.path.join(self.outputDir, fname)
+        stat = os.stat(path)
+        self.seen.add(fname)
+        self.changed = True
+        self.entries[fname] = {'inputs': self.inputs(invoicePage, timeDetailPages), 'checksum': fileHash(path), 'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+    def removeStale(self):
+        # only outputs this manifest wrote are ever deleted, anything else in the directory is left alone
+        stale = [fname for fname in self.entries if fname not in self.seen]
+        for fname in stale:
+            path = os.path.join(self.outputDir, fname)
+            if os.path.isfile(path):
+                os.remove(path)
+            del self.entries[fname]
+            self.changed = True
+        return stale
+
+    def save(self):
+        if not self.changed:
+            return
+        # written in one go without indenting so the C encoder does it, then swapped in so a crash
+        # never leaves half a manifest behind
+        tmpPath = self.path + '.tmp'
+        with open(tmpPath, 'w') as hManifest:
+            hManifest.write(json.dumps({'version': MANIFEST_VERSION, 'outputs': self.entries}))
+        os.replace(tmpPath, self.path)
+        self.changed = False
+
+    def finish(self):
+        # only call once every pair of the run has been checked or recorded, or current outputs
+        # would look stale
+        self.removed = self.removeStale()
+        self.save()
+        return self.removed
@@ -0,0 +1,61 @@
+import time
+import sqlite3
+import hashlib
+from functools import partial
+
+def fileHash(fname):
+    digest = hashlib.sha256()
+    with open(fname, 'rb') as hFile:
+        for block in iter(partial(hFile.read, 1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+class PageCache:
+    # Parsed page fields keyed by the source PDF's content hash, the parser that produced them
+    # (kind) and page number. Entries from another parser version are dropped on open, and once
+    # more than maxPages pages are stored the least recently used files are evicted.
+    def __init__(self, path, parserVersion, maxPages=200000):
+        self.parserVersion = parserVersion
+        self.maxPages = maxPages
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS files (fileHash TEXT, kind TEXT, parserVersion INTEGER, numPages INTEGER, lastUsed REAL, PRIMARY KEY (fileHash, kind))')
+        self.db.execute('CREATE TABLE IF NOT EXISTS pages (fileHash TEXT, kind TEXT, pageNum INTEGER, fields TEXT, PRIMARY KEY (fileHash, kind, pageNum))')
+        stale = self.db.execute('SELECT fileHash, kind FROM files WHERE parserVersion != ?', (parserVersion,)).fetchall()
+        for fileKey, kind in stale:
+            self.remove(fileKey, kind)
+        self.db.commit()
+
+    def get(self, fileKey, kind):
+        # returns (numPages, {pageNum: fields}), numPages is None if the file hasn't been seen
+        row = self.db.execute('SELECT numPages FROM files WHERE fileHash = ? AND kind = ?', (fileKey, kind)).fetchone()
+        if row is None:
+            return None, {}
+        self.db.execute('UPDATE files SET lastUsed = ? WHERE fileHash = ? AND kind = ?', (time.time(), fileKey, kind))
+        self.db.commit()
+        pages = self.db.execute('SELECT pageNum, fields FROM pages WHERE fileHash = ? AND kind = ?', (fileKey, kind))
+        return row[0], dict(pages)
+
+    def put(self, fileKey, kind, numPages, pages):
+        self.db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)', (fileKey, kind, self.parserVersion, numPages, time.time()))
+        self.db.executemany('INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?)', ((fileKey, kind, pageNum, fields) for pageNum, fields in pages.items()))
+        self.evict()
+        self.db.commit()
+
+    def remove(self, fileKey, kind):
+        self.db.execute('DELETE FROM pages WHERE fileHash = ? AND kind = ?', (fileKey, kind))
+        self.db.execute('DELETE FROM files WHERE fileHash = ? AND kind = ?', (fileKey, kind))
+
+    def evict(self):
+        storedPages = self.db.execute('SELECT COUNT(*) FROM pages').fetchone()[0]
+        if storedPages <= self.maxPages:
+            return
+        # always keep the most recently used file, even if it alone is over the cap
+        files = self.db.execute('SELECT fileHash, kind FROM files ORDER BY lastUsed, rowid').fetchall()[:-1]
+        for fileKey, kind in files:
+            storedPages -= self.db.execute('SELECT COUNT(*) FROM pages WHERE fileHash = ? AND kind = ?', (fileKey, kind)).fetchone()[0]
+            self.remove(fileKey, kind)
+            if storedPages <= self.maxPages:
+                break
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,101 @@
+from dataclasses import dataclass
+from typing import Any, Callable, List
+
+@dataclass
+class Field:
+    # The value of a field starts offset lines after the first line that's exactly anchor. parse
+    # gets up to count lines from there (at least one) and returns the value, without parse the
+    # first of those lines is the value. A missing optional field gets default instead of failing
+    # the page.
+    name: str
+    anchor: str
+    offset: int = 1
+    count: int = 1
+    parse: Callable[[List[str]], Any] = None
+    required: bool = True
+    default: Any = ''
+
+@dataclass
+class PageFailure:
+    pageNum: int
+    kind: str
+    message: str
+
+class FieldError(Exception):
+    pass
+
+def extractFields(layout, text):
+    # One pass over the page's lines finds the first line for every anchor in layout, then each
+    # field is read from there. Raises FieldError naming the field that couldn't be read.
+    lines = text.split('\n')
+    anchors = set(field.anchor for field in layout)
+    found = {}
+    for lineIdx, line in enumerate(lines):
+        if line in anchors and line not in found:
+            found[line] = lineIdx
+            if len(found) == len(anchors):
+                break
+
+    fields = {}
+    for field in layout:
+        start = found[field.anchor] + field.offset if field.anchor in found else len(lines)
+        if start >= len(lines):
+            if field.required and field.anchor not in found:
+                raise FieldError('no \'' + field.anchor + '\' line for ' + field.name)
+            if field.required:
+                raise FieldError('nothing after \'' + field.anchor + '\' for ' + field.name)
+            fields[field.name] = field.default
+            continue
+        values = lines[start:start + field.count]
+        if field.parse is None:
+            fields[field.name] = values[0]
+            continue
+        try:
+            fields[field.name] = field.parse(values)
+        except (IndexError, ValueError) as e:
+            raise FieldError('couldn\'t read ' + field.name + ' from \'' + values[0] + '\': ' + str(e))
+    return fields
+
+def extractRecord(layout, kind, pageNum, text, makeRecord):
+    # makeRecord(pageNum, fields) builds the typed record, a page that doesn't fit layout comes
+    # back as a PageFailure instead of raising so one bad page doesn't stop the run
+    try:
+        return makeRecord(pageNum, extractFields(layout, text))
+    except FieldError as e:
+        return PageFailure(pageNum, kind, str(e))
+
+def parseProjectHeader(lines):
+    # None on a time detail continuation page, otherwise the project number from either
+    # 'PGIM Real Estate:<number> <name>' or the PK layout, 'PGIM Real Estate:RE PK:<number>...'
+    header = lines[0]
+    if header.split(' ')[0] != 'PGIM':
+        return None
+    segments = header.split(':')
+    details = segments[1].split(' ')
+    if details[1] != 'PK':
+        return details[0]
+
+    prefix = segments[2]
+    lastChar = prefix[len(prefix) - 1]
+    if lastChar.isalpha():
+        # a one letter name follows the number
+        return prefix[:-2]
+    if lastChar == ' ':
+        return prefix.strip()
+    # the number carries on at the start of the next line
+    suffix = lines[1]
+    suffixLength = 0
+    while suffixLength < len(suffix) and (suffix[suffixLength] == '.' or suffix[suffixLength].isnumeric()):
+        suffixLength += 1
+    return prefix + suffix[:suffixLength]
+
+INVOICE_LAYOUT = [
+    Field('invoiceNum', 'Invoice No.'),
+    Field('projectNum', 'Project No.', parse=lambda lines: lines[0].split(' ')[0]),
+    Field('projectName', 'Project No.', parse=lambda lines: ' '.join(lines[0].split(' ')[1:])),
+    Field('amEmail', 'PGIM Real Estate', required=False),
+]
+
+TIME_DETAIL_LAYOUT = [
+    Field('projectNum', 'Notes', count=2, parse=parseProjectHeader),
+]
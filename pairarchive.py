@@ -0,0 +1,58 @@
+import io
+import os
+import json
+import time
+import tarfile
+import zipfile
+
+class PairArchive:
+    # Every merged PDF of a run as one .zip or .tar entry, stored without compression since the
+    # PDFs are mostly compressed already, plus index.json mapping each entry to its invoice and
+    # project number. Writes go through one large buffer, and the archive is written under a
+    # .partial name and only renamed into place by close(), so an interrupted run never leaves a
+    # complete looking archive behind, abandon() drops the partial file.
+    def __init__(self, path, bufferSize=1 << 23):
+        self.path = path
+        self.partialPath = path + '.partial'
+        self.hArchive = open(self.partialPath, 'wb', buffering=bufferSize)
+        if path.lower().endswith('.zip'):
+            self.zip = zipfile.ZipFile(self.hArchive, 'w', zipfile.ZIP_STORED)
+            self.tar = None
+        elif path.lower().endswith('.tar'):
+            self.zip = None
+            self.tar = tarfile.open(fileobj=self.hArchive, mode='w')
+        else:
+            self.hArchive.close()
+            os.remove(self.partialPath)
+            raise ValueError('Archive ' + path + ' has to end in .zip or .tar')
+        self.index = []
+
+    def add(self, name, data, invoiceNum, projectNum):
+        if self.zip is not None:
+            self.zip.writestr(zipfile.ZipInfo(name, time.localtime()[:6]), data)
+        else:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = time.time()
+            self.tar.addfile(info, io.BytesIO(data))
+        self.index.append({'invoiceNum': invoiceNum, 'projectNum': projectNum, 'entry': name})
+
+    def close(self):
+        self.add('index.json', json.dumps(self.index, indent=1).encode(), None, None)
+        self.index.pop()
+        if self.zip is not None:
+            self.zip.close()
+        else:
+            self.tar.close()
+        self.hArchive.close()
+        os.replace(self.partialPath, self.path)
+
+    def abandon(self):
+        try:
+            if self.zip is not None:
+                self.zip.close()
+            else:
+                self.tar.close()
+        finally:
+            self.hArchive.close()
+            os.remove(self.partialPath)
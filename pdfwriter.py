@@ -0,0 +1,164 @@
+import io
+from PyPDF2.generic import IndirectObject, DictionaryObject, ArrayObject, StreamObject, EncodedStreamObject, DecodedStreamObject, NameObject, NumberObject
+
+class UnsupportedSource(Exception):
+    pass
+
+class SharedObjectWriter:
+    # Writes merged PDFs for a whole run from the given source readers. Every source object gets
+    # the number of its idnum after the xref sizes of the readers before its own, so an output's
+    # bytes don't depend on which outputs were written before it or in which process. An object's
+    # serialized bytes are kept once a second output uses it, so fonts, images and other shared
+    # resources are only encoded once while per page objects aren't held. Each output still
+    # carries every object it uses and gets its own page tree, catalog and an xref made of one
+    # subsection per run of consecutive object numbers. Encrypted sources and pages whose
+    # resources point back at a page raise UnsupportedSource, for PdfFileWriter to handle.
+    def __init__(self, readers):
+        self.readers = readers
+        self.offsets = {}
+        offset = 0
+        for reader in readers:
+            size = int(reader.trailer['/Size'])
+            self.offsets[id(reader)] = (offset, size)
+            offset += size
+        self.end = max(offset, 1)
+        self.refs = {}
+        self.sources = {}
+        self.uses = {}
+        self.encoded = {}
+        self.added = []
+
+    def objectNumber(self, ref):
+        offset, size = self.offsets.get(id(ref.pdf), (None, 0))
+        if offset is None or ref.idnum >= size:
+            raise UnsupportedSource('object ' + str(ref.idnum) + ' is outside its source\'s xref')
+        return offset + ref.idnum
+
+    def register(self, ref):
+        num = self.objectNumber(ref)
+        if num in self.refs:
+            return num
+        obj = ref.getObject()
+        if isinstance(obj, DictionaryObject) and obj.get('/Type') in ('/Page', '/Pages'):
+            raise UnsupportedSource('object ' + str(ref.idnum) + ' refers back to the page tree')
+        # recorded before remapping so a reference cycle ends here
+        refs = []
+        self.refs[num] = refs
+        self.sources[num] = ref
+        self.added.append(num)
+        self.remap(obj, refs)
+        return num
+
+    def remap(self, obj, refs):
+        # copy of obj with every indirect reference renumbered to the run's numbering
+        if isinstance(obj, IndirectObject):
+            num = self.register(obj)
+            refs.append(num)
+            return IndirectObject(num, 0, None)
+        if isinstance(obj, StreamObject):
+            copy = EncodedStreamObject() if isinstance(obj, EncodedStreamObject) else DecodedStreamObject()
+            copy._data = obj._data
+            for key, value in obj.items():
+                # StreamObject writes its own /Length from the data
+                if key != '/Length':
+                    copy[key] = self.remap(value, refs)
+            return copy
+        if isinstance(obj, DictionaryObject):
+            copy = DictionaryObject()
+            for key, value in obj.items():
+                copy[key] = self.remap(value, refs)
+            return copy
+        if isinstance(obj, ArrayObject):
+            return ArrayObject([self.remap(value, refs) for value in obj])
+        return obj
+
+    def encode(self, num, obj):
+        data = io.BytesIO()
+        data.write(str(num).encode() + b' 0 obj\n')
+        obj.writeToStream(data, None)
+        data.write(b'\nendobj\n')
+        return data.getvalue()
+
+    def objectBytes(self, num):
+        if num in self.encoded:
+            return self.encoded[num]
+        data = self.encode(num, self.remap(self.sources[num].getObject(), []))
+        if self.uses[num] > 1:
+            self.encoded[num] = data
+        return data
+
+    def rollback(self):
+        # forget the objects first seen while writing an output that turned out to be unsupported,
+        # some of them never got all their references recorded
+        for num in self.added:
+            del self.refs[num]
+            del self.sources[num]
+        self.added = []
+
+    def write(self, pages):
+        # pages is a list of (reader, pageNum), returns the bytes of a standalone PDF of those pages
+        self.added = []
+        pageDicts = []
+        rootRefs = []
+        try:
+            for reader, pageNum in pages:
+                if reader.isEncrypted:
+                    raise UnsupportedSource('encrypted source')
+                page = reader.getPage(pageNum)
+                pageDict = DictionaryObject()
+                for key, value in page.items():
+                    if key != '/Parent':
+                        pageDict[key] = self.remap(value, rootRefs)
+                pageDicts.append(pageDict)
+        except UnsupportedSource:
+            self.rollback()
+            raise
+
+        needed = set()
+        pending = list(rootRefs)
+        while len(pending) > 0:
+            num = pending.pop()
+            if num not in needed:
+                needed.add(num)
+                pending += self.refs[num]
+        for num in needed:
+            self.uses[num] = self.uses.get(num, 0) + 1
+
+        # the page tree and catalog are only for this output, numbered past every source object
+        pagesNum = self.end
+        catalogNum = pagesNum + len(pageDicts) + 1
+        output = io.BytesIO()
+        output.write(b'%PDF-1.3\n')
+        offsets = {}
+        for num in sorted(needed):
+            offsets[num] = output.tell()
+            output.write(self.objectBytes(num))
+        for pageIdx, pageDict in enumerate(pageDicts):
+            pageDict[NameObject('/Parent')] = IndirectObject(pagesNum, 0, None)
+            offsets[pagesNum + 1 + pageIdx] = output.tell()
+            output.write(self.encode(pagesNum + 1 + pageIdx, pageDict))
+        pageTree = DictionaryObject({
+            NameObject('/Type'): NameObject('/Pages'),
+            NameObject('/Kids'): ArrayObject([IndirectObject(pagesNum + 1 + pageIdx, 0, None) for pageIdx in range(len(pageDicts))]),
+            NameObject('/Count'): NumberObject(len(pageDicts)),
+        })
+        offsets[pagesNum] = output.tell()
+        output.write(self.encode(pagesNum, pageTree))
+        catalog = DictionaryObject({NameObject('/Type'): NameObject('/Catalog'), NameObject('/Pages'): IndirectObject(pagesNum, 0, None)})
+        offsets[catalogNum] = output.tell()
+        output.write(self.encode(catalogNum, catalog))
+
+        xrefOffset = output.tell()
+        output.write(b'xref\n')
+        nums = [0] + sorted(offsets)
+        start = 0
+        while start < len(nums):
+            end = start + 1
+            while end < len(nums) and nums[end] == nums[end - 1] + 1:
+                end += 1
+            output.write(('%d %d\n' % (nums[start], end - start)).encode())
+            for num in nums[start:end]:
+                output.write(b'0000000000 65535 f \n' if num == 0 else ('%010d 00000 n \n' % offsets[num]).encode())
+            start = end
+        output.write(('trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (catalogNum + 1, catalogNum, xrefOffset)).encode())
+        return output.getvalue()
@@ -1,15 +1,33 @@
+import io
 import os
+import json
+import time
 import PyPDF2
+import numpy as np
 import argparse
 from tqdm import tqdm
 import pylightxl as xl
-from typing import List
+from typing import Dict, List
 from pathlib import Path
 from fuzzywuzzy import fuzz
 import multiprocessing as mp
 from functools import partial
-from scipy.optimize import fmin
-from dataclasses import dataclass
+from contextlib import redirect_stdout
+from collections import Counter, deque
+from dataclasses import dataclass, field, asdict, is_dataclass
+from pagecache import PageCache, fileHash
+from metrics import Metrics
+from outputmanifest import OutputManifest
+from workbooksnapshot import snapshotPath, readSnapshot, writeSnapshot
+from pdfwriter import SharedObjectWriter, UnsupportedSource
+from pairarchive import PairArchive
+from sourcepdf import MappedPdfReader, leadingLines
+from delivery import SentLedger, SmtpPool, planDeliveries, deliver
+from pagefields import PageFailure, extractRecord, INVOICE_LAYOUT, TIME_DETAIL_LAYOUT
+
+# bump whenever parseInvoicePage or parseTimeDetailPage change what they return for a page,
+# so pages cached by the old parser get thrown away
+PARSER_VERSION = 2
 
 @dataclass
 class Invoice:
@@ -29,113 +47,812 @@ class PairedData:
     invoice: Invoice
     timeDetail: TimeDetail
 
-def extractInvoices(invoiceFname):
-    parsedInvoices = []
-    hInvoices = open(invoiceFname, 'rb')
-    invoicesReader = PyPDF2.PdfFileReader(hInvoices)
-    print('Parsing invoices from ' + invoiceFname + '...')
-    
-    for pageNum in tqdm(range(invoicesReader.numPages)):
-        invoicesZ = invoicesReader.getPage(pageNum)
-        lines = invoicesZ.extractText().split('\n')
-        invoiceNum = lines[lines.index('Invoice No.') + 1]
-        pNameNum = lines[lines.index('Project No.') + 1]
-        try:
-            amEmail = lines[lines.index('PGIM Real Estate') + 1]
-        except:
-            amEmail = ''
-        pName = ' '.join(pNameNum.split(' ')[1:])
-        pNum = pNameNum.split(' ')[0]
-        parsedInvoices.append(Invoice(pageNum, pName, pNum, invoiceNum, amEmail))
-    
-    hInvoices.close()
-    return parsedInvoices
+@dataclass
+class PairingReport:
+    pairs: List[PairedData]
+    unmatchedInvoices: List[Invoice]
+    duplicateTimeDetails: Dict[str, List[TimeDetail]]
+    orphanTimeDetails: List[TimeDetail]
+    pageFailures: List[PageFailure] = field(default_factory=list)
+
+def parseInvoicePage(pageNum, text):
+    return extractRecord(INVOICE_LAYOUT, 'invoice', pageNum, text, lambda pageNum, fields: Invoice(pageNum, **fields))
+
+def parseTimeDetailPage(pageNum, text):
+    # the project number on a page that starts a time detail block, None on a continuation page
+    return extractRecord(TIME_DETAIL_LAYOUT, 'time detail', pageNum, text, lambda pageNum, fields: fields['projectNum'])
 
-def extractTimeDetail(timeDetailFname):
-    hTimeDetail = open(timeDetailFname, 'rb')
-    timeDetailReader = PyPDF2.PdfFileReader(hTimeDetail)
+def joinTimeDetailPages(pageHeaders):
+    # pageHeaders holds the project number for pages that start a new time detail block and None
+    # for continuation pages, in page order. Pages that couldn't be read stay in the list as
+    # PageFailures, and so do continuation pages without a readable header before them.
     timeDetails = []
-    print('Parsing time detail from ' + timeDetailFname + '...')
+    block = None
+    for pageNum, pName in enumerate(pageHeaders):
+        if isinstance(pName, PageFailure):
+            timeDetails.append(pName)
+            block = None
+        elif pName is not None:
+            block = TimeDetail([pageNum], pName)
+            timeDetails.append(block)
+        elif block is None:
+            timeDetails.append(orphanContinuation(pageNum))
+        else:
+            block.pages.append(pageNum)
+    return timeDetails
 
-    for pageNum in tqdm(range(timeDetailReader.numPages)):
-        td0 = timeDetailReader.getPage(pageNum)
-        lines = td0.extractText().split('\n')
-        
-        notesIdx = lines.index('Notes')
-        onNewPage = lines[notesIdx + 1].split(' ')[0] == 'PGIM'
-        
-        if onNewPage:
-            pNum = lines[notesIdx + 1]
-            nameDetails = pNum.split(':')[1].split(' ')
-            if nameDetails[1] == 'PK':
-                pNamePrefix = lines[notesIdx+1].split(':')[2]
-                pNameSuffix = lines[notesIdx+2]
-                middleChar = pNamePrefix[len(pNamePrefix) - 1]
-                if str.isalpha(middleChar):
-                    pName = pNamePrefix[:-2]
-                elif middleChar == ' ':
-                    pName = pNamePrefix.strip()
-                else: # pNamePrefix last char is '.' or numeric
-                    specialIdx = 0
-                    pName = pNamePrefix
-                    while pNameSuffix[specialIdx] == '.' or str.isnumeric(pNameSuffix[specialIdx]):
-                        pName += pNameSuffix[specialIdx]
-                        specialIdx += 1
+def probeTimeDetailPage(pageNum, page):
+    # parseTimeDetailPage for a page, reading only the start of its content stream when that's
+    # enough. The line after 'Notes' not being a project header is all it takes to know a
+    # continuation page, and a short stream decoded to its end is the page's whole text anyway.
+    # Whenever the start of the page doesn't settle it the full text is parsed. The header is near
+    # the top, so a short start of the page is tried before a longer one.
+    anchor = TIME_DETAIL_LAYOUT[0].anchor
+    for maxBytes in (512, 4096):
+        leading = leadingLines(page, maxBytes)
+        if leading is None:
+            break
+        lines, complete = leading
+        if complete:
+            return parseTimeDetailPage(pageNum, '\n'.join(lines))
+        if anchor in lines:
+            headerIdx = lines.index(anchor) + 1
+            if headerIdx < len(lines):
+                if lines[headerIdx].split(' ')[0] != 'PGIM':
+                    return None
+                break
+    return parseTimeDetailPage(pageNum, page.extractText())
+
+def orphanContinuation(pageNum):
+    return PageFailure(pageNum, 'time detail', 'continues a project but no readable project header came before it')
+
+def pageChunks(pageNums, processes, maxChunkSize=64):
+    # several chunks per worker so a slow chunk doesn't leave the others idle, and none so long that
+    # a task queued behind it waits for long
+    chunkSize = max(1, min(maxChunkSize, -(-len(pageNums) // (processes * 4))))
+    return [pageNums[start:start + chunkSize] for start in range(0, len(pageNums), chunkSize)]
+
+workerReaders = {}
+
+def sourceReader(fname):
+    # worker side, each source PDF is opened once per process and reused for every task on it
+    reader = workerReaders.get(fname)
+    if reader is None:
+        reader = MappedPdfReader(fname)
+        workerReaders[fname] = reader
+    return reader
+
+def timeParsePage(parsePage, reader, pageNum):
+    start = time.perf_counter()
+    try:
+        with reader.releasing([pageNum]):
+            page = reader.getPage(pageNum)
+            if parsePage is parseTimeDetailPage:
+                result = probeTimeDetailPage(pageNum, page)
             else:
-                pName = nameDetails[0]
-            timeDetail = TimeDetail([pageNum], pName)
-            timeDetails.append(timeDetail)
+                result = parsePage(pageNum, page.extractText())
+    except Exception as e:
+        # a page PyPDF2 can't read, a corrupt stream say, fails on its own like a page that doesn't fit its layout
+        kind = 'invoice' if parsePage is parseInvoicePage else 'time detail'
+        result = PageFailure(pageNum, kind, type(e).__name__ + ': ' + str(e))
+    return result, time.perf_counter() - start
+
+def parsePages(fname, parsePage, pageNums):
+    reader = sourceReader(fname)
+    return [timeParsePage(parsePage, reader, pageNum) for pageNum in pageNums]
+
+def parseChunks(pool, fname, parsePage, chunks, window):
+    # Yields parsePages' results for every chunk in order, with at most window chunks queued on
+    # pool at a time. Other tasks sent to a shared pool, like streamMergePairs' writes, then only
+    # wait behind those instead of behind the rest of the file.
+    queued = deque()
+    nextChunk = 0
+    while nextChunk < len(chunks) or len(queued) > 0:
+        while nextChunk < len(chunks) and len(queued) < window:
+            queued.append(pool.apply_async(parsePages, (fname, parsePage, chunks[nextChunk])))
+            nextChunk += 1
+        yield from queued.popleft().get()
+
+def encodePage(result):
+    return json.dumps(asdict(result) if is_dataclass(result) else result)
+
+def decodePage(parsePage, fields):
+    fields = json.loads(fields)
+    return Invoice(**fields) if parsePage is parseInvoicePage else fields
+
+def iterPages(fname, parsePage, processes=1, cache=None, stage=None, pool=None):
+    # Yields (pageNum, numPages, parsed page) in page order. With a PageCache only the pages it
+    # doesn't have for this file's contents get parsed, and they're written back every 1000 pages.
+    # Each page's parse time is recorded on stage when it's given. Pages are parsed on pool when
+    # one is passed in, otherwise on a pool of its own when processes > 1.
+    pageLabel = os.path.basename(fname) + ' page '
+    cached = {}
+    if cache is not None:
+        fileKey = fileHash(fname)
+        numPages, cachedPages = cache.get(fileKey, parsePage.__name__)
+        cached = {pageNum: decodePage(parsePage, fields) for pageNum, fields in cachedPages.items()}
+        if numPages is not None and len(cached) == numPages:
+            for pageNum in range(numPages):
+                if stage:
+                    stage.item(pageLabel + str(pageNum + 1))
+                yield pageNum, numPages, cached.pop(pageNum)
+            return
+
+    with MappedPdfReader(fname) as reader:
+        numPages = reader.numPages
+        pageNums = [pageNum for pageNum in range(numPages) if pageNum not in cached]
+        ownPool = None
+        if pool is None and processes > 1 and len(pageNums) > 0:
+            ownPool = pool = mp.Pool(processes=processes)
+        if pool is not None and len(pageNums) > 0:
+            parsed = parseChunks(pool, fname, parsePage, pageChunks(pageNums, processes), processes * 2)
         else:
-            timeDetails[len(timeDetails) - 1].pages.append(pageNum)
+            parsed = (timeParsePage(parsePage, reader, pageNum) for pageNum in pageNums)
 
-    hTimeDetail.close()
-    return timeDetails
+        try:
+            newPages = {}
+            for pageNum in range(numPages):
+                if pageNum in cached:
+                    result = cached.pop(pageNum)
+                    seconds = None
+                else:
+                    result, seconds = next(parsed)
+                    # failed pages aren't cached, they get another go on the next run
+                    if cache is not None and not isinstance(result, PageFailure):
+                        newPages[pageNum] = encodePage(result)
+                        if len(newPages) >= 1000:
+                            cache.put(fileKey, parsePage.__name__, numPages, newPages)
+                            newPages = {}
+                if stage:
+                    stage.item(pageLabel + str(pageNum + 1), seconds)
+                yield pageNum, numPages, result
+            if cache is not None and len(newPages) > 0:
+                cache.put(fileKey, parsePage.__name__, numPages, newPages)
+        finally:
+            if ownPool is not None:
+                ownPool.terminate()
+
+def extractPages(fname, parsePage, processes=1, progress=None, cache=None, stage=None):
+    results = []
+    for pageNum, numPages, result in iterPages(fname, parsePage, processes, cache, stage):
+        results.append(result)
+        if progress:
+            progress(pageNum + 1, numPages)
+    return results
+
+def updateBar(bar, done, total):
+    bar.total = total
+    bar.update(done - bar.n)
+
+def extractInvoices(invoiceFname, processes=1, cache=None, stage=None):
+    print('Parsing invoices from ' + invoiceFname + '...')
+    with tqdm() as bar:
+        return extractPages(invoiceFname, parseInvoicePage, processes, partial(updateBar, bar), cache, stage)
+
+def extractTimeDetail(timeDetailFname, processes=1, cache=None, stage=None):
+    print('Parsing time detail from ' + timeDetailFname + '...')
+    with tqdm() as bar:
+        pageHeaders = extractPages(timeDetailFname, parseTimeDetailPage, processes, partial(updateBar, bar), cache, stage)
+    return joinTimeDetailPages(pageHeaders)
 
 def pairData(invoices, timeDetail):
-    pairedData = []
     print('Pairing invoices and time details...')
+    report = PairingReport([], [], {}, [])
+    report.pageFailures = [page for page in invoices + timeDetail if isinstance(page, PageFailure)]
+    invoices = [inv for inv in invoices if not isinstance(inv, PageFailure)]
+    timeDetail = [td for td in timeDetail if not isinstance(td, PageFailure)]
+
+    timeDetailIndex = {}
+    for td in timeDetail:
+        timeDetailIndex.setdefault(td.projectNum, []).append(td)
 
-    for inv in tqdm(invoices):
-        pairedTimeDetail = None
-        for td in timeDetail:
-            if inv.projectNum == td.projectNum:
-                pairedTimeDetail = td
-        if pairedTimeDetail == None:
-            print('Couldn\'t find matching time detail for invoice!')
-            print('Page ' + str(inv.pageNum + 1) + ': Invoice ' + inv.invoiceNum + ' for ' + inv.projectNum + ' ' + inv.projectName)
+    claimed = set()
+    for inv in invoices:
+        matches = timeDetailIndex.get(inv.projectNum)
+        if matches is None:
+            report.unmatchedInvoices.append(inv)
         else:
-            pairedData.append(PairedData(inv, pairedTimeDetail))
+            # the last block for a project number wins, any others end up in duplicateTimeDetails
+            report.pairs.append(PairedData(inv, matches[len(matches) - 1]))
+            claimed.add(inv.projectNum)
 
-    return pairedData
+    for projectNum, matches in timeDetailIndex.items():
+        if len(matches) > 1:
+            report.duplicateTimeDetails[projectNum] = matches
+        if projectNum not in claimed:
+            report.orphanTimeDetails += matches
+    return report
 
-def mergePairs(pairedData, invoiceFname, timeDetailFname, outputDir):
-    invoiceReader = PyPDF2.PdfFileReader(invoiceFname)
-    timeDetailReader = PyPDF2.PdfFileReader(timeDetailFname)
-    
+def describePairing(report):
+    lines = []
+    for failure in report.pageFailures:
+        lines.append('Couldn\'t read ' + failure.kind + ' page ' + str(failure.pageNum + 1) + ': ' + failure.message)
+    for inv in report.unmatchedInvoices:
+        lines.append('Couldn\'t find matching time detail for invoice! Page ' + str(inv.pageNum + 1) + ': Invoice ' + inv.invoiceNum + ' for ' + inv.projectNum + ' ' + inv.projectName)
+    for projectNum, matches in report.duplicateTimeDetails.items():
+        lines.append('Project ' + projectNum + ' has ' + str(len(matches)) + ' time detail blocks, starting on pages ' + ', '.join(str(td.pages[0] + 1) for td in matches))
+    for td in report.orphanTimeDetails:
+        lines.append('No invoice for time detail ' + td.projectNum + ' on page ' + str(td.pages[0] + 1))
+    return lines
+
+def outputName(invoice):
+    return 'ASM_AN_' + invoice.projectNum + '_' + invoice.projectName.replace('\\', '.').replace('/', '.') + '_' + str(invoice.invoiceNum) + '.pdf'
+
+def outputPath(outputDir, invoice):
+    return Path(outputDir + '/' + outputName(invoice))
+
+def renderPair(invoiceReader, timeDetailReader, pair, writer=None):
+    # the pages are dropped from the readers again once the merged PDF is written
+    with invoiceReader.releasing([pair.invoice.pageNum]), timeDetailReader.releasing(pair.timeDetail.pages):
+        return renderPages(invoiceReader, timeDetailReader, pair, writer)
+
+def renderPages(invoiceReader, timeDetailReader, pair, writer):
+    # with a SharedObjectWriter the pages' shared resources come out of its cache, PdfFileWriter
+    # is kept for sources it can't take
+    if writer is not None:
+        try:
+            return writer.write([(invoiceReader, pair.invoice.pageNum)] + [(timeDetailReader, p) for p in pair.timeDetail.pages])
+        except UnsupportedSource:
+            pass
+    pdfWriter = PyPDF2.PdfFileWriter()
+    pdfWriter.addPage(invoiceReader.getPage(pair.invoice.pageNum))
+
+    for p in pair.timeDetail.pages:
+        pdfWriter.addPage(timeDetailReader.getPage(p))
+    output = io.BytesIO()
+    pdfWriter.write(output)
+    return output.getvalue()
+
+def archiveEntry(pair, data):
+    # PairArchive.add arguments for a merged PDF, named the same as its file would be
+    return outputName(pair.invoice), data, pair.invoice.invoiceNum, pair.invoice.projectNum
+
+def writePair(invoiceReader, timeDetailReader, pair, outputDir, writer=None, archive=None):
+    start = time.perf_counter()
+    data = renderPair(invoiceReader, timeDetailReader, pair, writer)
+    if archive is not None:
+        archive.add(*archiveEntry(pair, data))
+    else:
+        with outputPath(outputDir, pair.invoice).open('wb') as outputFile:
+            outputFile.write(data)
+    return time.perf_counter() - start
+
+mergeReaders = None
+
+def openMergeReaders(invoiceFname, timeDetailFname):
+    # pool initializer, each worker opens both source PDFs once and keeps them, and its writer's
+    # shared objects, for every pair it takes
+    global mergeReaders
+    invoiceReader = sourceReader(invoiceFname)
+    timeDetailReader = sourceReader(timeDetailFname)
+    mergeReaders = (invoiceReader, timeDetailReader, SharedObjectWriter([invoiceReader, timeDetailReader]))
+
+def writeWorkerPair(outputDir, pair):
+    # without an outputDir the merged PDF goes back to the parent as an archive entry
+    if outputDir is None:
+        start = time.perf_counter()
+        entry = archiveEntry(pair, renderPair(mergeReaders[0], mergeReaders[1], pair, mergeReaders[2]))
+        return os.getpid(), pair.invoice.invoiceNum, time.perf_counter() - start, entry
+    return os.getpid(), pair.invoice.invoiceNum, writePair(mergeReaders[0], mergeReaders[1], pair, outputDir, mergeReaders[2]), None
+
+def outputIsCurrent(manifest, outputDir, pair):
+    return manifest is not None and manifest.isCurrent(outputPath(outputDir, pair.invoice).name, pair.invoice.pageNum, pair.timeDetail.pages)
+
+def recordOutput(manifest, outputDir, pair):
+    if manifest is not None:
+        manifest.record(outputPath(outputDir, pair.invoice).name, pair.invoice.pageNum, pair.timeDetail.pages)
+
+def writeMergedPairs(pairedData, invoiceFname, timeDetailFname, outputDir, processes=1, progress=None, stage=None, manifest=None, archive=None):
+    # progress is called with (done, total, pairs written by each worker). With an OutputManifest
+    # pairs whose output is still up to date are skipped and stale outputs are removed at the end.
+    # With a PairArchive every merged PDF goes into it instead of outputDir.
+    if manifest is not None:
+        pending = []
+        for pair in pairedData:
+            if outputIsCurrent(manifest, outputDir, pair):
+                if stage:
+                    stage.item('invoice ' + str(pair.invoice.invoiceNum))
+            else:
+                pending.append(pair)
+        pairedData = pending
+
+    if processes <= 1 and len(pairedData) > 0:
+        with MappedPdfReader(invoiceFname) as invoiceReader, MappedPdfReader(timeDetailFname) as timeDetailReader:
+            writer = SharedObjectWriter([invoiceReader, timeDetailReader])
+            for done, pair in enumerate(pairedData):
+                seconds = writePair(invoiceReader, timeDetailReader, pair, outputDir, writer, archive)
+                recordOutput(manifest, outputDir, pair)
+                if stage:
+                    stage.item('invoice ' + str(pair.invoice.invoiceNum), seconds)
+                if progress:
+                    progress(done + 1, len(pairedData), [done + 1])
+    elif len(pairedData) > 0:
+        workers = {}
+        workerPairs = []
+        with mp.Pool(processes=processes, initializer=openMergeReaders, initargs=(invoiceFname, timeDetailFname)) as pool:
+            # chunksize 1 keeps the pairs on the pool's shared task queue, so a worker stuck on a long
+            # time detail doesn't hold back pairs another worker could take
+            for done, (workerPid, invoiceNum, seconds, entry) in enumerate(pool.imap_unordered(partial(writeWorkerPair, None if archive is not None else outputDir), pairedData, chunksize=1)):
+                if entry is not None:
+                    archive.add(*entry)
+                if stage:
+                    stage.item('invoice ' + str(invoiceNum), seconds)
+                if workerPid not in workers:
+                    workers[workerPid] = len(workers)
+                    workerPairs.append(0)
+                workerPairs[workers[workerPid]] += 1
+                if progress:
+                    progress(done + 1, len(pairedData), workerPairs)
+        for pair in pairedData:
+            recordOutput(manifest, outputDir, pair)
+
+    if manifest is not None:
+        return manifest.finish()
+    return []
+
+def updateMergeBar(bar, done, total, workerPairs):
+    updateBar(bar, done, total)
+    if len(workerPairs) > 1:
+        bar.set_postfix_str(' '.join('w' + str(worker) + ':' + str(count) for worker, count in enumerate(workerPairs)), refresh=False)
+
+def deliverPairs(pairedData, outputDir, pool, sender, ledger, bundle=False, stage=None):
+    # Emails each account manager the merged PDFs of their invoices that the ledger doesn't have as
+    # sent to them yet, one message per manager. Returns [(delivery, error)] for failed messages.
+    outputs = [(pair.invoice.amEmail, str(outputPath(outputDir, pair.invoice))) for pair in pairedData if '@' in pair.invoice.amEmail]
+    deliveries, alreadySent = planDeliveries(outputs, ledger)
+    print('Sending ' + str(sum(len(delivery.paths) for delivery in deliveries)) + ' merged PDFs to ' + str(len(set(delivery.recipient for delivery in deliveries))) + ' account managers...')
+    if len(outputs) < len(pairedData):
+        print(str(len(pairedData) - len(outputs)) + ' merged PDFs have no account manager email and were not sent')
+    if alreadySent > 0:
+        print(str(alreadySent) + ' merged PDFs were already sent')
+    with tqdm(total=len(deliveries)) as bar:
+        failures = deliver(deliveries, pool, sender, ledger, bundle, partial(updateBar, bar))
+    if stage:
+        stage.items = len(deliveries)
+    for delivery, error in failures:
+        print('Could not send ' + str(len(delivery.paths)) + ' merged PDFs to ' + delivery.recipient + ': ' + error)
+    return failures
+
+def mergePairs(pairedData, invoiceFname, timeDetailFname, outputDir, processes=1, stage=None, manifest=None, archive=None):
     print('Merging pairs to disk...')
-    for pair in tqdm(pairedData):
-        invoicePage = pair.invoice.pageNum
-        timeDetailPages = pair.timeDetail.pages
-        pdfWriter = PyPDF2.PdfFileWriter()
-        pdfWriter.addPage(invoiceReader.getPage(invoicePage))
-    
-        for p in timeDetailPages:
-            pdfWriter.addPage(timeDetailReader.getPage(p))
-        with Path(outputDir + '/ASM_AN_' + pair.invoice.projectNum + '_' + pair.invoice.projectName.replace('\\', '.').replace('/', '.') + '_' + str(pair.invoice.invoiceNum) + '.pdf').open('wb') as outputFile:
-            pdfWriter.write(outputFile)
-
-def findPropertyNameEntryCandidates(db, pName, fuzzRatio):
-    candidates = []
-    for wsName in db.ws_names:
-        for rowNum, row in enumerate(db.ws(wsName).col(col=3)[2:]):
-            if fuzz.ratio(pName, row) >= fuzzRatio:
-                candidates.append(db.ws(wsName).row(rowNum + 3))
-    return candidates
-
-    bestFullMatch = 0
-    bestRatio = 0
-
-def maxFullAndPartial(fuzzRatio, db, pairedData, dbg):
+    with tqdm() as bar:
+        stale = writeMergedPairs(pairedData, invoiceFname, timeDetailFname, outputDir, processes, partial(updateMergeBar, bar), stage, manifest, archive)
+    if manifest is not None:
+        print(str(len(pairedData) - bar.n) + ' merged PDFs already up to date, ' + str(len(stale)) + ' stale ones removed')
+
+def streamPairs(invoicePages, timeDetailPages, report, progress=None):
+    # Takes the iterPages generators for both PDFs, reading from whichever is further behind, and
+    # yields each PairedData as soon as its invoice page and complete time detail block have been
+    # read. Only blocks and invoices still waiting for their other half are kept around, a paired
+    # block is only held by its pair in report.pairs and found again through pairedBlocks for
+    # another invoice with the same project number. Unlike pairData an invoice pairs with the
+    # latest block seen so far, earlier blocks for the same project number are kept for
+    # report.duplicateTimeDetails.
+    unpairedBlocks = {}
+    pairedBlocks = {}
+    earlierBlocks = {}
+    pendingInvoices = {}
+    claimed = set()
+    block = None
+    invoicesRead = timeDetailsRead = 0
+    invoicePagesTotal = timeDetailPagesTotal = 1
+
+    def latestBlock(projectNum):
+        if projectNum in unpairedBlocks:
+            return unpairedBlocks[projectNum]
+        if projectNum in pairedBlocks:
+            return report.pairs[pairedBlocks[projectNum]].timeDetail
+        return None
+
+    def addPair(inv, td):
+        claimed.add(td.projectNum)
+        unpairedBlocks.pop(td.projectNum, None)
+        pairedBlocks[td.projectNum] = len(report.pairs)
+        report.pairs.append(PairedData(inv, td))
+        return report.pairs[len(report.pairs) - 1]
+
+    def completeBlock(td):
+        earlier = latestBlock(td.projectNum)
+        if earlier is not None:
+            earlierBlocks.setdefault(td.projectNum, []).append(earlier)
+            pairedBlocks.pop(td.projectNum, None)
+        unpairedBlocks[td.projectNum] = td
+        for inv in pendingInvoices.pop(td.projectNum, []):
+            yield addPair(inv, td)
+
+    while invoicePages is not None or timeDetailPages is not None:
+        if timeDetailPages is None or (invoicePages is not None and invoicesRead * timeDetailPagesTotal <= timeDetailsRead * invoicePagesTotal):
+            page = next(invoicePages, None)
+            if page is None:
+                invoicePages = None
+                continue
+            pageNum, invoicePagesTotal, inv = page
+            invoicesRead = pageNum + 1
+            if isinstance(inv, PageFailure):
+                report.pageFailures.append(inv)
+            else:
+                td = latestBlock(inv.projectNum)
+                if td is None:
+                    pendingInvoices.setdefault(inv.projectNum, []).append(inv)
+                else:
+                    yield addPair(inv, td)
+        else:
+            page = next(timeDetailPages, None)
+            if page is None:
+                timeDetailPages = None
+                if block is not None:
+                    yield from completeBlock(block)
+                continue
+            pageNum, timeDetailPagesTotal, pName = page
+            timeDetailsRead = pageNum + 1
+            if pName is not None:
+                if block is not None:
+                    yield from completeBlock(block)
+                block = None
+                if isinstance(pName, PageFailure):
+                    report.pageFailures.append(pName)
+                else:
+                    block = TimeDetail([pageNum], pName)
+            elif block is None:
+                report.pageFailures.append(orphanContinuation(pageNum))
+            else:
+                block.pages.append(pageNum)
+        if progress:
+            progress(invoicesRead + timeDetailsRead, invoicePagesTotal + timeDetailPagesTotal)
+
+    for invs in pendingInvoices.values():
+        report.unmatchedInvoices += invs
+    report.unmatchedInvoices.sort(key=lambda inv: inv.pageNum)
+    report.pageFailures.sort(key=lambda failure: (failure.kind, failure.pageNum))
+    # in order of each project's first block, like pairData
+    for projectNum, earlier in sorted(earlierBlocks.items(), key=lambda item: item[1][0].pages[0]):
+        report.duplicateTimeDetails[projectNum] = earlier + [latestBlock(projectNum)]
+    orphans = [earlierBlocks.get(projectNum, []) + [td] for projectNum, td in unpairedBlocks.items() if projectNum not in claimed]
+    for blocks in sorted(orphans, key=lambda blocks: blocks[0].pages[0]):
+        report.orphanTimeDetails += blocks
+    report.pairs.sort(key=lambda pair: pair.invoice.pageNum)
+
+def finishWrite(writing, stage, manifest=None, outputDir=None, archive=None):
+    pair, result = writing
+    workerPid, invoiceNum, seconds, entry = result.get()
+    if entry is not None:
+        archive.add(*entry)
+    recordOutput(manifest, outputDir, pair)
+    if stage:
+        stage.item('invoice ' + str(invoiceNum), seconds)
+    return pair
+
+def streamMergePairs(invoiceFname, timeDetailFname, outputDir, report, processes=1, cache=None, progress=None, stage=None, manifest=None, archive=None):
+    # Parses, pairs and writes in one pass, yielding each pair once its merged PDF is on disk.
+    # report is filled in as streamPairs goes and is complete once this is exhausted. With an
+    # OutputManifest up to date outputs aren't rewritten, and stale ones are only removed if the
+    # run gets to the end; a run stopped early just saves what it wrote. With processes > 1 one
+    # pool parses both files and writes the merged PDFs, so there are never more than processes
+    # workers.
+    pool = None
+    if processes > 1:
+        pool = mp.Pool(processes=processes, initializer=openMergeReaders, initargs=(invoiceFname, timeDetailFname))
+    invoicePages = iterPages(invoiceFname, parseInvoicePage, processes, cache, stage, pool)
+    timeDetailPages = iterPages(timeDetailFname, parseTimeDetailPage, processes, cache, stage, pool)
+    pairs = streamPairs(invoicePages, timeDetailPages, report, progress)
+    completed = False
+    try:
+        if pool is None:
+            with MappedPdfReader(invoiceFname) as invoiceReader, MappedPdfReader(timeDetailFname) as timeDetailReader:
+                writer = SharedObjectWriter([invoiceReader, timeDetailReader])
+                for pair in pairs:
+                    if outputIsCurrent(manifest, outputDir, pair):
+                        seconds = None
+                    else:
+                        seconds = writePair(invoiceReader, timeDetailReader, pair, outputDir, writer, archive)
+                        recordOutput(manifest, outputDir, pair)
+                    if stage:
+                        stage.item('invoice ' + str(pair.invoice.invoiceNum), seconds)
+                    yield pair
+        else:
+            # keep a few writes per worker in flight so parsing never waits on disk and memory stays bounded
+            writing = deque()
+            for pair in pairs:
+                if outputIsCurrent(manifest, outputDir, pair):
+                    if stage:
+                        stage.item('invoice ' + str(pair.invoice.invoiceNum))
+                    yield pair
+                    continue
+                writing.append((pair, pool.apply_async(writeWorkerPair, (None if archive is not None else outputDir, pair))))
+                while len(writing) > 0 and (len(writing) > processes * 4 or writing[0][1].ready()):
+                    yield finishWrite(writing.popleft(), stage, manifest, outputDir, archive)
+            while len(writing) > 0:
+                yield finishWrite(writing.popleft(), stage, manifest, outputDir, archive)
+        completed = True
+        if manifest is not None:
+            manifest.finish()
+    finally:
+        if manifest is not None and not completed:
+            manifest.save()
+        pairs.close()
+        invoicePages.close()
+        timeDetailPages.close()
+        if pool is not None:
+            pool.terminate()
+
+def pickPair(pdfs):
+    # (invoice PDF, time detail PDF) out of a list of PDF names, None unless there's exactly one of each
+    invoiceFnames = [fname for fname in pdfs if 'invoice' in fname.lower()]
+    timeDetailFnames = [fname for fname in pdfs if 'time' in fname.lower()]
+    if len(invoiceFnames) != 1 or len(timeDetailFnames) != 1:
+        return None
+    return invoiceFnames[0], timeDetailFnames[0]
+
+def printSkip(path, reason):
+    print('Skipping ' + path + ', ' + reason)
+
+def findBatches(source, onSkip=printSkip):
+    # source is either a directory with one subdirectory per batch, each holding an invoice PDF and
+    # a time detail PDF, or a manifest with one "InvoiceFile,TimeDetailFile[,name]" line per batch.
+    # An invoice PDF and a time detail PDF straight in the directory are one more batch, named after
+    # the invoice PDF. onSkip(path, reason) is called for every entry of the directory that isn't
+    # used. Returns (name, invoiceFname, timeDetailFname) tuples, names are used as output
+    # subdirectories.
+    batches = []
+    if os.path.isdir(source):
+        loosePdfs = []
+        for name in sorted(os.listdir(source)):
+            batchDir = os.path.join(source, name)
+            if not os.path.isdir(batchDir):
+                if name.lower().endswith('.pdf'):
+                    loosePdfs.append(name)
+                else:
+                    onSkip(batchDir, 'it is neither a PDF nor a batch folder')
+                continue
+            pair = pickPair([fname for fname in sorted(os.listdir(batchDir)) if fname.lower().endswith('.pdf')])
+            if pair is None:
+                onSkip(batchDir, 'it needs exactly one invoice PDF and one time detail PDF')
+                continue
+            batches.append((name, os.path.join(batchDir, pair[0]), os.path.join(batchDir, pair[1])))
+
+        if len(loosePdfs) > 0:
+            pair = pickPair(loosePdfs)
+            if pair is None:
+                for fname in loosePdfs:
+                    onSkip(os.path.join(source, fname), 'PDFs outside a batch folder need to be exactly one invoice PDF and one time detail PDF')
+            else:
+                batches.append((os.path.splitext(pair[0])[0], os.path.join(source, pair[0]), os.path.join(source, pair[1])))
+        return batches
+
+    manifestDir = os.path.dirname(os.path.abspath(source))
+    with open(source) as hManifest:
+        for lineNum, line in enumerate(hManifest):
+            line = line.strip()
+            if line == '' or line.startswith('#'):
+                continue
+            fields = [field.strip() for field in line.split(',')]
+            if len(fields) < 2:
+                raise ValueError('Manifest ' + source + ' line ' + str(lineNum + 1) + ' needs an invoice file and a time detail file')
+            invoiceFname, timeDetailFname = [os.path.join(manifestDir, fname) for fname in fields[:2]]
+            name = fields[2] if len(fields) > 2 and fields[2] != '' else os.path.splitext(os.path.basename(invoiceFname))[0] + '_' + str(len(batches) + 1)
+            batches.append((name, invoiceFname, timeDetailFname))
+    return batches
+
+batchCache = None
+
+def openBatchWorker(cachePath):
+    # pool initializer, every worker keeps its own connection to the page cache
+    global batchCache
+    batchCache = None if cachePath is None else PageCache(cachePath, PARSER_VERSION)
+
+def runBatch(outputRoot, reuseOutputs, batch):
+    # Parses, pairs and merges one batch start to finish in this process, quietly since several
+    # batches run at once. Returns (name, PairingReport, seconds).
+    name, invoiceFname, timeDetailFname = batch
+    start = time.perf_counter()
+    outputDir = os.path.join(outputRoot, name)
+    os.makedirs(outputDir, exist_ok=True)
+    with redirect_stdout(io.StringIO()):
+        invoices = extractPages(invoiceFname, parseInvoicePage, 1, None, batchCache)
+        timeDetail = joinTimeDetailPages(extractPages(timeDetailFname, parseTimeDetailPage, 1, None, batchCache))
+        report = pairData(invoices, timeDetail)
+        writeMergedPairs(report.pairs, invoiceFname, timeDetailFname, outputDir, manifest=OutputManifest(outputDir, invoiceFname, timeDetailFname, reuseOutputs))
+    return name, report, time.perf_counter() - start
+
+def tryRunBatch(outputRoot, reuseOutputs, batch):
+    # runBatch plus an error, None unless the batch failed, in which case there's no report and
+    # the other batches carry on
+    start = time.perf_counter()
+    try:
+        return runBatch(outputRoot, reuseOutputs, batch) + (None,)
+    except Exception as e:
+        return batch[0], None, time.perf_counter() - start, type(e).__name__ + ': ' + str(e)
+
+def runBatches(batches, outputRoot, processes=1, cachePath=None, reuseOutputs=True):
+    # Every batch goes to the first free worker, biggest first (by source file size) so a large
+    # batch never starts last and holds up the whole run. Yields (name, PairingReport, seconds,
+    # error) as batches finish, see tryRunBatch.
+    if len(batches) == 0:
+        return
+    batches = sorted(batches, key=lambda batch: os.path.getsize(batch[1]) + os.path.getsize(batch[2]), reverse=True)
+    if processes <= 1:
+        openBatchWorker(cachePath)
+        for batch in batches:
+            yield tryRunBatch(outputRoot, reuseOutputs, batch)
+        return
+
+    with mp.Pool(processes=min(processes, len(batches)), initializer=openBatchWorker, initargs=(cachePath,)) as pool:
+        for result in pool.imap_unordered(partial(tryRunBatch, outputRoot, reuseOutputs), batches, chunksize=1):
+            yield result
+
+def describeBatch(name, report, seconds, pairCandidates):
+    fullMatches = 0 if pairCandidates is None else sum(1 for pair, candidates in pairCandidates if len(candidates) == 1)
+    return {
+        'name': name,
+        'seconds': seconds,
+        'pairs': len(report.pairs),
+        'fullMatches': fullMatches,
+        'unmatchedInvoices': len(report.unmatchedInvoices),
+        'duplicateProjects': len(report.duplicateTimeDetails),
+        'orphanTimeDetails': len(report.orphanTimeDetails),
+        'pageFailures': len(report.pageFailures),
+        'issues': describePairing(report),
+    }
+
+class PropertyNameIndex:
+    # Built once per workbook load over the property name column (col 3, from row 3) of every
+    # sheet. fuzz.ratio is 2 * matched chars / total length and can never match more chars than
+    # the two strings share, so a per-row character count lets a lookup drop every row that
+    # can't reach the ratio before scoring the rest with fuzz.ratio. db is None when
+    # loadPropertyNameIndex fills the index in from a snapshot, the workbook is then only read the
+    # first time a full row is needed.
+    def __init__(self, db, workbookFname=None):
+        self.db = db
+        self.workbookFname = workbookFname
+        if db is None:
+            return
+        self.rows = []
+        self.names = []
+        for wsName in db.ws_names:
+            for rowNum, name in enumerate(db.ws(wsName).col(col=3)[2:]):
+                self.rows.append((wsName, rowNum + 3))
+                self.names.append(name)
+
+        self.alphabet = {}
+        for name in self.names:
+            if isinstance(name, str):
+                for char in name:
+                    self.alphabet.setdefault(char, len(self.alphabet))
+
+        # an Excel cell holds at most 32767 chars, so any count fits in 16 bits
+        self.charCounts = np.zeros((len(self.alphabet), len(self.names)), dtype=np.uint16)
+        self.lengths = np.zeros(len(self.names), dtype=np.int64)
+        # non-text cells are always scored so they behave exactly like the full scan
+        self.unindexed = np.zeros(len(self.names), dtype=bool)
+        for rowIdx, name in enumerate(self.names):
+            if isinstance(name, str):
+                for char, count in Counter(name).items():
+                    self.charCounts[self.alphabet[char], rowIdx] = count
+                self.lengths[rowIdx] = len(name)
+            else:
+                self.unindexed[rowIdx] = True
+
+    def shortlist(self, pName, fuzzRatio):
+        if not isinstance(pName, str):
+            return np.arange(len(self.names))
+        counts = Counter(pName)
+        chars = [char for char in counts if char in self.alphabet]
+        cols = [self.alphabet[char] for char in chars]
+        queryCounts = np.array([counts[char] for char in chars], dtype=np.int32).reshape(-1, 1)
+        shared = np.minimum(self.charCounts[cols], queryCounts).sum(axis=0)
+        # fuzz.ratio rounds, so a row is reachable if 100 * 2 * shared / total >= fuzzRatio - 0.5
+        reachable = 400 * shared >= (2 * fuzzRatio - 1) * (self.lengths + len(pName))
+        return np.nonzero(reachable | self.unindexed)[0]
+
+    def row(self, rowIdx):
+        if self.db is None:
+            self.db = xl.readxl(fn=self.workbookFname)
+        return self.db.ws(self.rows[rowIdx][0]).row(self.rows[rowIdx][1])
+
+    def scores(self, pName, fuzzRatio):
+        rowIdxs = self.shortlist(pName, fuzzRatio)
+        return rowIdxs, np.array([fuzz.ratio(pName, self.names[rowIdx]) for rowIdx in rowIdxs], dtype=np.int32)
+
+def loadPropertyNameIndex(workbookFname):
+    # Uses the snapshot next to the workbook when it was made from the workbook's current contents,
+    # otherwise reads the workbook and writes a new snapshot for next time
+    workbookHash = fileHash(workbookFname)
+    path = snapshotPath(workbookFname)
+    snapshot = readSnapshot(path, workbookHash)
+    if snapshot is not None:
+        index = PropertyNameIndex(None, workbookFname)
+        index.names, index.rows, alphabet, arrays = snapshot
+        index.alphabet = {char: charIdx for charIdx, char in enumerate(alphabet)}
+        index.charCounts = arrays['charCounts']
+        index.lengths = arrays['lengths']
+        index.unindexed = arrays['unindexed']
+        return index
+
+    index = PropertyNameIndex(xl.readxl(fn=workbookFname), workbookFname)
+    try:
+        writeSnapshot(path, workbookHash, index.names, index.rows, list(index.alphabet), {'charCounts': index.charCounts, 'lengths': index.lengths, 'unindexed': index.unindexed})
+    except (OSError, TypeError) as e:
+        print('Couldn\'t write workbook snapshot ' + path + ': ' + str(e))
+    return index
+
+class LazyRows:
+    # Candidate rows kept as row indexes, a row is only fetched from the workbook once it's read
+    def __init__(self, index, rowIdxs):
+        self.index = index
+        self.rowIdxs = rowIdxs
+
+    def __len__(self):
+        return len(self.rowIdxs)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self.index.row(rowIdx) for rowIdx in self.rowIdxs[item]]
+        return self.index.row(self.rowIdxs[item])
+
+    def __iter__(self):
+        return (self.index.row(rowIdx) for rowIdx in self.rowIdxs)
+
+    def __repr__(self):
+        return repr(list(self))
+
+class MatchScores:
+    # Scores every invoice project name, and the words longer than 5 chars used as its fallback,
+    # against the index once. Only scores >= minRatio are kept, so any ratio >= minRatio can be
+    # read back without rescoring.
+    def __init__(self, index, pairedData, minRatio):
+        self.index = index
+        self.pairedData = pairedData
+        self.minRatio = minRatio
+        self.scored = {}
+
+        nameCounts = np.zeros((len(pairedData), 102), dtype=np.int32)
+        wordCounts = np.zeros((len(pairedData), 102), dtype=np.int32)
+        for pairIdx, pair in enumerate(pairedData):
+            pName = pair.invoice.projectName
+            nameCounts[pairIdx] = self.countsAtLeast(pName)
+            for word in pName.split(' '):
+                if len(word) > 5:
+                    wordCounts[pairIdx] += self.countsAtLeast(word)
+        # candidateCounts[pair, ratio] is how many candidates the pair gets at that ratio,
+        # falling back to the words only when the full name has none
+        self.candidateCounts = np.where(nameCounts > 0, nameCounts, wordCounts)
+
+    def score(self, pName):
+        if pName not in self.scored:
+            rowIdxs, scores = self.index.scores(pName, self.minRatio)
+            keep = scores >= self.minRatio
+            self.scored[pName] = (rowIdxs[keep], scores[keep])
+        return self.scored[pName]
+
+    def countsAtLeast(self, pName):
+        # counts[r] is the number of rows scoring >= r, for r in 0..101
+        histogram = np.bincount(self.score(pName)[1], minlength=102)
+        return histogram[::-1].cumsum()[::-1]
+
+    def rowIdxsAtLeast(self, pName, fuzzRatio):
+        rowIdxs, scores = self.score(pName)
+        return list(rowIdxs[scores >= fuzzRatio])
+
+    def candidates(self, pName, fuzzRatio):
+        rowIdxs = self.rowIdxsAtLeast(pName, fuzzRatio)
+        if len(rowIdxs) == 0:
+            for word in pName.split(' '):
+                if len(word) > 5:
+                    rowIdxs += self.rowIdxsAtLeast(word, fuzzRatio)
+        return LazyRows(self.index, rowIdxs)
+
+def sweepThresholds(scores, fuzzRatios):
+    counts = scores.candidateCounts[:, np.clip(list(fuzzRatios), 0, 101)]
+    fullMatched = (counts == 1).sum(axis=0)
+    partialMatched = (counts > 1).sum(axis=0)
+    # same as mapping maxFullAndPartial over fuzzRatios, which gives (0, 0) for a ratio without
+    # any partial matches
+    return [(fuzzRatio, int(full)) if partial > 0 else (0, 0) for fuzzRatio, full, partial in zip(fuzzRatios, fullMatched, partialMatched)]
+
+def maxFullAndPartial(fuzzRatio, scores, dbg):
+    if fuzzRatio < scores.minRatio:
+        scores = MatchScores(scores.index, scores.pairedData, fuzzRatio)
+    pairedData = scores.pairedData
     partialMatched = 0
     fullMatched = 0
     noMatch = 0
@@ -143,12 +860,7 @@ def maxFullAndPartial(fuzzRatio, db, pairedData, dbg):
     partialMatchCounts = []
     pairCandidates = []
     for pair in pairedData:
-        pName = pair.invoice.projectName
-        candidates = findPropertyNameEntryCandidates(db, pName, fuzzRatio)
-        if len(candidates) == 0:
-            for word in pName.split(' '):
-                if len(word) > 5:
-                    candidates += findPropertyNameEntryCandidates(db, word, fuzzRatio)
+        candidates = scores.candidates(pair.invoice.projectName, fuzzRatio)
         if len(candidates) > 1:
             partialMatched += 1
             partialMatchCounts.append(len(candidates))
@@ -173,49 +885,277 @@ def maxFullAndPartial(fuzzRatio, db, pairedData, dbg):
     except:
         return (0, 0, None)
 
-def statisticalAnalysis(dbD, pairedDataD):
+def statisticalAnalysis(indexD, pairedDataD, fuzzRatios=range(30, 71)):
     print('Running statistical analysis...')
-    pool = mp.Pool(processes=16)
-    results = pool.map(partial(maxFullAndPartial, db=dbD, pairedData=pairedDataD, dbg=False), range(30, 72, 2))
+    scores = MatchScores(indexD, pairedDataD, min(fuzzRatios))
+    results = sweepThresholds(scores, fuzzRatios)
     bestPair = (0, 0)
     
     for r in results:
         if bestPair[1] < r[1]:
             bestPair = r
     print('Best ratio: ' + str(bestPair[0]))
-    return maxFullAndPartial(bestPair[0], db=dbD, pairedData=pairedDataD, dbg=True)[2]
+    return maxFullAndPartial(bestPair[0], scores, dbg=True)[2]
+
+class AssetAssignments:
+    # Holds the PropertyNameIndex for a workbook and only reads the workbook again when its mtime changes
+    def __init__(self, fname):
+        self.fname = fname
+        self.mtime = None
+        self.index = None
 
+    def current(self):
+        mtime = os.stat(self.fname).st_mtime_ns
+        if mtime != self.mtime:
+            print('Loading asset assignments from ' + self.fname + '...')
+            self.index = loadPropertyNameIndex(self.fname)
+            self.mtime = mtime
+        return self.index
+
+def batchSignature(batch):
+    return tuple((os.stat(fname).st_size, os.stat(fname).st_mtime_ns) for fname in batch[1:])
+
+def finishWatchedBatch(outputRoot, assets, name, result):
+    try:
+        name, report, seconds = result.get()
+    except Exception as e:
+        print('Batch ' + name + ' failed: ' + str(e))
+        return
+    summary = describeBatch(name, report, seconds, statisticalAnalysis(assets.current(), report.pairs))
+    with open(os.path.join(outputRoot, name, 'summary.json'), 'w') as hSummary:
+        json.dump(summary, hSummary, indent=2)
+    print(name + ': ' + str(summary['pairs']) + ' pairs, ' + str(len(summary['issues'])) + ' issues in ' + ('%.1f' % seconds) + 's')
+
+def watchInbox(inbox, outputRoot, assetAssignmentsFname, processes=1, cachePath=None, reuseOutputs=True, pollSeconds=2.0):
+    # Service mode, runs until interrupted. The workbook index and the worker pool are set up once
+    # and kept, and every batch folder or invoice and time detail PDF pair that turns up in inbox
+    # (laid out like findBatches expects) is run through runBatch on the pool. A batch is only
+    # picked up once its PDFs have the same size and mtime on two polls in a row, so half copied
+    # files are left alone, and it runs again if its PDFs change later. Each batch's summary goes to
+    # summary.json in its output folder. Inbox entries that can't be used are printed once, and
+    # again if they change or come back after being fixed.
+    assets = AssetAssignments(assetAssignmentsFname)
+    assets.current()
+    processed = {}
+    settling = {}
+    running = {}
+    skipped = {}
+    stillSkipped = set()
+
+    def reportSkip(path, reason):
+        stillSkipped.add(path)
+        if skipped.get(path) != reason:
+            skipped[path] = reason
+            printSkip(path, reason)
+
+    with mp.Pool(processes=max(1, processes), initializer=openBatchWorker, initargs=(cachePath,)) as pool:
+        print('Watching ' + inbox + ' for batches...')
+        while True:
+            ready = []
+            stillSkipped.clear()
+            batches = findBatches(inbox, reportSkip)
+            for path in [path for path in skipped if path not in stillSkipped]:
+                del skipped[path]
+            for batch in batches:
+                name = batch[0]
+                try:
+                    signature = batchSignature(batch)
+                except OSError:
+                    continue
+                if name in running or processed.get(name) == signature:
+                    continue
+                if settling.get(name) != signature:
+                    settling[name] = signature
+                    continue
+                del settling[name]
+                processed[name] = signature
+                ready.append(batch)
+
+            for batch in sorted(ready, key=lambda batch: os.path.getsize(batch[1]) + os.path.getsize(batch[2]), reverse=True):
+                print('Processing ' + batch[0] + '...')
+                running[batch[0]] = pool.apply_async(runBatch, (outputRoot, reuseOutputs, batch))
+
+            for name in [name for name, result in running.items() if result.ready()]:
+                finishWatchedBatch(outputRoot, assets, name, running.pop(name))
+            time.sleep(pollSeconds)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Invoice automator')
-    parser.add_argument('InvoiceFile', type=str, help='Path to invoice PDF')
-    parser.add_argument('TimeDetailFile', type=str, help='Path to time detail PDF')
-    parser.add_argument('OutputDirectory', type=str, help='Path to place merged PDFs')
+    parser.add_argument('InvoiceFile', type=str, nargs='?', help='Path to invoice PDF')
+    parser.add_argument('TimeDetailFile', type=str, nargs='?', help='Path to time detail PDF')
+    parser.add_argument('OutputDirectory', type=str, nargs='?', help='Path to place merged PDFs')
+    parser.add_argument('--batch', type=str, nargs=2, metavar=('SOURCE', 'OUTPUT'), help='Process every batch in SOURCE, a directory of batch folders or a manifest of "InvoiceFile,TimeDetailFile[,name]" lines, into a folder per batch under OUTPUT')
+    parser.add_argument('--watch', type=str, nargs=2, metavar=('INBOX', 'OUTPUT'), help='Keep running and process every batch folder or invoice and time detail PDF pair that shows up in INBOX into a folder per batch under OUTPUT')
+    parser.add_argument('--poll', type=float, default=2.0, help='Seconds between checks of the --watch inbox')
+    parser.add_argument('-j', '--processes', type=int, default=1, help='Worker processes used to parse and merge PDF pages, or to run batches side by side with --batch')
+    parser.add_argument('--cache', type=str, default='page_cache.sqlite', help='Path to the parsed page cache')
+    parser.add_argument('--no-cache', action='store_true', help='Parse every page without reading or writing the page cache')
+    parser.add_argument('--archive', type=str, help='Name of a .zip or .tar in OutputDirectory to write every merged PDF into, with an index.json of invoice and project numbers, instead of one file each')
+    parser.add_argument('--send', type=str, metavar='HOST[:PORT]', help='SMTP server to email every account manager the merged PDFs of their invoices through, the password for --smtp-user is read from PGIM_SMTP_PASSWORD')
+    parser.add_argument('--sender', type=str, help='From address of the --send messages')
+    parser.add_argument('--smtp-user', type=str, help='User to log in to the --send server as')
+    parser.add_argument('--starttls', action='store_true', help='Use STARTTLS with the --send server')
+    parser.add_argument('--smtp-connections', type=int, default=4, help='Messages sent side by side, each over its own SMTP connection')
+    parser.add_argument('--send-rate', type=float, default=2.0, help='Most messages a second to send, 0 for no limit')
+    parser.add_argument('--bundle', action='store_true', help='Attach each account manager\'s merged PDFs as one zip')
+    parser.add_argument('--rewrite', action='store_true', help='Rewrite every merged PDF even if the output manifest says it is up to date')
+    parser.add_argument('--stream', action='store_true', help='Write each merged PDF as soon as its pages are parsed instead of parsing everything first')
+    parser.add_argument('--metrics', type=str, help='Path to write per stage timings, throughput, peak memory and slow pages as JSON')
+    parser.add_argument('--profile', type=str, help='Directory to save a cProfile dump of each stage in')
     args = parser.parse_args()
 
-    if not os.path.isfile(args.InvoiceFile):
-        print('Invoice file ' + args.InvoiceFile + ' does not exist!')
-        os._exit(-1)
-    if not os.path.isfile(args.TimeDetailFile):
-        print('Time detail file ' + args.TimeDetailFile + ' does not exist!')
-        os._exit(-1)
-    if not os.path.isdir(args.OutputDirectory):
-        print('Output directory ' + args.OutputDirectory + ' does not exist!')
-        os._exit(-1)
+    if args.batch is None and args.watch is None and args.OutputDirectory is None:
+        parser.error('InvoiceFile, TimeDetailFile and OutputDirectory are required unless --batch or --watch is given')
+    if args.archive is not None and (args.batch is not None or args.watch is not None):
+        parser.error('--archive only works with a single InvoiceFile and TimeDetailFile')
+    if args.send is not None:
+        if args.batch is not None or args.watch is not None:
+            parser.error('--send only works with a single InvoiceFile and TimeDetailFile')
+        if args.archive is not None:
+            parser.error('--send needs the merged PDFs as files, not an --archive')
+        if args.sender is None:
+            parser.error('--send needs a --sender address')
+    if args.watch is not None:
+        if not os.path.isdir(args.watch[0]):
+            print('Inbox directory ' + args.watch[0] + ' does not exist!')
+            os._exit(-1)
+        if not os.path.isdir(args.watch[1]):
+            print('Output directory ' + args.watch[1] + ' does not exist!')
+            os._exit(-1)
+    elif args.batch is not None:
+        if not os.path.exists(args.batch[0]):
+            print('Batch source ' + args.batch[0] + ' does not exist!')
+            os._exit(-1)
+        if not os.path.isdir(args.batch[1]):
+            print('Output directory ' + args.batch[1] + ' does not exist!')
+            os._exit(-1)
+    else:
+        if not os.path.isfile(args.InvoiceFile):
+            print('Invoice file ' + args.InvoiceFile + ' does not exist!')
+            os._exit(-1)
+        if not os.path.isfile(args.TimeDetailFile):
+            print('Time detail file ' + args.TimeDetailFile + ' does not exist!')
+            os._exit(-1)
+        if not os.path.isdir(args.OutputDirectory):
+            print('Output directory ' + args.OutputDirectory + ' does not exist!')
+            os._exit(-1)
+    if args.profile is not None:
+        os.makedirs(args.profile, exist_ok=True)
 
     invoiceFname = args.InvoiceFile
     timeDetailFname = args.TimeDetailFile
     assetAssignmentsFname = 'asset_assignments.xlsx'
 
-    invoices = extractInvoices(invoiceFname)
-    timeDetail = extractTimeDetail(timeDetailFname)
-    pairedData = pairData(invoices, timeDetail)
+    metrics = Metrics(trackMemory=args.metrics is not None, profileDir=args.profile)
+    if args.watch is not None:
+        try:
+            watchInbox(args.watch[0], args.watch[1], assetAssignmentsFname, args.processes, None if args.no_cache else args.cache, not args.rewrite, args.poll)
+        except KeyboardInterrupt:
+            print('Stopped watching ' + args.watch[0])
+    elif args.batch is not None:
+        batches = findBatches(args.batch[0])
+        missing = [fname for batch in batches for fname in batch[1:] if not os.path.isfile(fname)]
+        if len(missing) > 0:
+            print('Batch file ' + missing[0] + ' does not exist!')
+            os._exit(-1)
+
+        # the workbook is loaded once and shared by every batch's analysis
+        with metrics.stage('loadAssetAssignments') as stage:
+            index = loadPropertyNameIndex(assetAssignmentsFname)
+            stage.items = len(index.names)
+
+        print('Processing ' + str(len(batches)) + ' batches from ' + args.batch[0] + '...')
+        results = []
+        with metrics.stage('runBatches') as stage, tqdm(total=len(batches)) as bar:
+            for name, report, seconds, error in runBatches(batches, args.batch[1], args.processes, None if args.no_cache else args.cache, not args.rewrite):
+                stage.item(name, seconds)
+                results.append((name, report, seconds, error))
+                bar.update(1)
+
+        summaries = []
+        failedBatches = []
+        with metrics.stage('statisticalAnalysis') as stage:
+            for name, report, seconds, error in sorted(results, key=lambda result: result[0]):
+                if error is not None:
+                    failedBatches.append({'name': name, 'seconds': seconds, 'error': error})
+                    continue
+                print(name + ':')
+                summaries.append(describeBatch(name, report, seconds, statisticalAnalysis(index, report.pairs)))
+                stage.items += len(report.pairs)
+
+        summary = {'batches': summaries, 'failedBatches': failedBatches}
+        for total in ['pairs', 'fullMatches', 'unmatchedInvoices', 'duplicateProjects', 'orphanTimeDetails', 'pageFailures']:
+            summary[total] = sum(batchSummary[total] for batchSummary in summaries)
+        summaryFname = os.path.join(args.batch[1], 'batch_summary.json')
+        with open(summaryFname, 'w') as hSummary:
+            json.dump(summary, hSummary, indent=2)
+
+        for batchSummary in summaries:
+            print(batchSummary['name'].ljust(30) + str(batchSummary['pairs']).rjust(7) + ' pairs' + str(len(batchSummary['issues'])).rjust(7) + ' issues' + ('%.1f' % batchSummary['seconds']).rjust(9) + 's')
+        for failedBatch in failedBatches:
+            print(failedBatch['name'].ljust(30) + ' failed: ' + failedBatch['error'])
+        print('Total'.ljust(30) + str(summary['pairs']).rjust(7) + ' pairs' + str(sum(len(batchSummary['issues']) for batchSummary in summaries)).rjust(7) + ' issues')
+        print('Summary written to ' + summaryFname)
+    else:
+        pageCache = None if args.no_cache else PageCache(args.cache, PARSER_VERSION)
+        # an archive is written whole every run, so there's no manifest to keep for it
+        archive = None if args.archive is None else PairArchive(os.path.join(args.OutputDirectory, args.archive))
+        manifest = None if archive is not None else OutputManifest(args.OutputDirectory, invoiceFname, timeDetailFname, not args.rewrite)
+        try:
+            if args.stream:
+                print('Parsing, pairing and merging ' + invoiceFname + ' and ' + timeDetailFname + '...')
+                pairingReport = PairingReport([], [], {}, [])
+                with metrics.stage('streamMergePairs') as stage, tqdm() as bar:
+                    for written, pair in enumerate(streamMergePairs(invoiceFname, timeDetailFname, args.OutputDirectory, pairingReport, args.processes, pageCache, partial(updateBar, bar), stage, manifest, archive)):
+                        bar.set_postfix_str(str(written + 1) + ' written', refresh=False)
+                if manifest is not None:
+                    print(str(len(manifest.removed)) + ' stale merged PDFs removed')
+            else:
+                with metrics.stage('extractInvoices') as stage:
+                    invoices = extractInvoices(invoiceFname, args.processes, pageCache, stage)
+                with metrics.stage('extractTimeDetail') as stage:
+                    timeDetail = extractTimeDetail(timeDetailFname, args.processes, pageCache, stage)
+                with metrics.stage('pairData') as stage:
+                    pairingReport = pairData(invoices, timeDetail)
+                    stage.items = len(invoices)
+                with metrics.stage('mergePairs') as stage:
+                    mergePairs(pairingReport.pairs, invoiceFname, timeDetailFname, args.OutputDirectory, args.processes, stage, manifest, archive)
+        except:
+            # an interrupted or failed run leaves no .partial archive behind
+            if archive is not None:
+                archive.abandon()
+            raise
+        if archive is not None:
+            archive.close()
+            print('Merged PDFs written to ' + archive.path)
+        for line in describePairing(pairingReport):
+            print(line)
+        pairedData = pairingReport.pairs
+
+        if args.send is not None:
+            host, _, port = args.send.partition(':')
+            pool = SmtpPool(host, int(port) if port else 25, args.smtp_connections, args.smtp_user, os.environ.get('PGIM_SMTP_PASSWORD'), args.starttls, args.send_rate)
+            # the ledger stays with the outputs so a rerun into the same directory never sends twice
+            ledger = SentLedger(os.path.join(args.OutputDirectory, 'sent_ledger.sqlite'))
+            try:
+                with metrics.stage('deliverPairs') as stage:
+                    deliverPairs(pairedData, args.OutputDirectory, pool, args.sender, ledger, args.bundle, stage)
+            finally:
+                pool.close()
+                ledger.close()
 
-    #mergePairs(pairedData, invoiceFname, timeDetailFname, args.OutputDirectory)
+        #print('Done. I love you Mom!')
 
-    #print('Done. I love you Mom!')
 
+        with metrics.stage('loadAssetAssignments') as stage:
+            index = loadPropertyNameIndex(assetAssignmentsFname)
+            stage.items = len(index.names)
+        with metrics.stage('statisticalAnalysis') as stage:
+            pairCandidates = statisticalAnalysis(index, pairedData)
+            stage.items = len(pairedData)
+        #print(pairCandidates)
 
-    db = xl.readxl(fn=assetAssignmentsFname)
-    pairCandidates = statisticalAnalysis(db, pairedData)
-    #print(pairCandidates)
+    if args.metrics is not None:
+        metrics.export(args.metrics)
+    elif args.profile is not None:
+        metrics.export(os.path.join(args.profile, 'metrics.json'))
@@ -0,0 +1,240 @@
+import re
+import mmap
+import zlib
+import bisect
+import PyPDF2
+from contextlib import contextmanager
+from PyPDF2.generic import NameObject, IndirectObject, ArrayObject, DictionaryObject, StreamObject, DecodedStreamObject
+
+INHERITABLE_PAGE_ATTRIBUTES = (NameObject('/Resources'), NameObject('/MediaBox'), NameObject('/CropBox'), NameObject('/Rotate'))
+OBJECT_HEADER = re.compile(rb'\s*(\d+)\s+(\d+)\s+obj\b')
+PAGE_TYPE = re.compile(rb'/Type\s*/(Pages|Page)\b')
+# a direct /Count, not an indirect reference to one
+PAGE_COUNT = re.compile(rb'/Count\s+(\d+)\b(?!\s+\d+\s+R\b)')
+
+class MappedPdfReader(PyPDF2.PdfFileReader):
+    # A PdfFileReader over a read only memory map of the source PDF instead of a copy of it read into
+    # memory, so every process reading the same file shares the OS page cache. Pages are found by
+    # walking down the page tree, each /Pages node on the way gets a table of where its kids' pages
+    # start, with its /Pages kids taken at their /Count, the first time a lookup goes through it,
+    # and pages are only made into PageObjects when asked for. So a lookup only reads the nodes on
+    # its way down, and a /Count is trusted for the subtrees it skips. Kids are told apart from
+    # their bytes in the file where that's unambiguous, so a flat tree's table doesn't parse every
+    # page dictionary either. A node whose /Count isn't what its kids add up to would put pages at
+    # the wrong numbers, so once a lookup comes across one, and for an encrypted file, it falls
+    # back to flattening the whole tree like PdfFileReader.
+    def __init__(self, fname):
+        self.hPdf = open(fname, 'rb')
+        self.mapped = mmap.mmap(self.hPdf.fileno(), 0, access=mmap.ACCESS_READ)
+        self.pageTables = {}
+        self.pageObjects = {}
+        self.tracking = []
+        PyPDF2.PdfFileReader.__init__(self, self.mapped)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        # objects already read from the file stay usable, nothing more can be read after this
+        self.mapped.close()
+        self.hPdf.close()
+
+    def cacheIndirectObject(self, generation, idnum, obj):
+        for tracked in self.tracking:
+            tracked.append((generation, idnum))
+        return PyPDF2.PdfFileReader.cacheIndirectObject(self, generation, idnum, obj)
+
+    @contextmanager
+    def releasing(self, pageNumbers):
+        # Objects read from the file inside this are dropped again at the end, along with the
+        # PageObjects of pageNumbers, so a pass over a long document doesn't keep every page in
+        # memory. The catalog, the page tree and object streams stay since every lookup needs them.
+        tracked = []
+        self.tracking.append(tracked)
+        try:
+            yield
+        finally:
+            self.tracking.remove(tracked)
+            for pageNumber in pageNumbers:
+                self.pageObjects.pop(pageNumber, None)
+            for key in tracked:
+                obj = self.resolvedObjects.get(key)
+                if not isinstance(obj, DictionaryObject) or (obj.get('/Type') not in ('/Catalog', '/ObjStm') and '/Kids' not in obj):
+                    self.resolvedObjects.pop(key, None)
+
+    def usePageTables(self):
+        # False when the tree has to be flattened instead
+        return not self.isEncrypted and self.flattenedPages is None and self.pageTables is not False
+
+    def pageTable(self, node):
+        # (node, starts, kids) for a /Pages node, built the first time it's needed. None, and no
+        # more page tables for this reader, when the node's /Count doesn't match its kids.
+        table = self.pageTables.get(id(node))
+        if table is not None:
+            return table
+        starts = []
+        kids = list(node['/Kids'])
+        numPages = 0
+        for kid in kids:
+            starts.append(numPages)
+            kidPages = self.kidPages(kid)
+            if kidPages is None:
+                numPages = None
+                break
+            numPages += kidPages
+        if numPages is None or '/Count' not in node or int(node['/Count']) != numPages:
+            self.pageTables = False
+            return None
+        # the node is kept with its table so its id() isn't reused by another object
+        table = (node, starts, kids)
+        self.pageTables[id(node)] = table
+        return table
+
+    def kidPages(self, kid):
+        # pages under a kid of a /Pages node, 1 for a page and its /Count for a /Pages node, None
+        # when that isn't a count
+        peeked = self.peekKidPages(kid)
+        if peeked is not None:
+            return peeked
+        kidObj = kid.getObject()
+        if kidObj.get('/Type', '/Pages') != '/Pages':
+            return 1
+        if '/Count' in kidObj and int(kidObj['/Count']) >= 0:
+            return int(kidObj['/Count'])
+        return None
+
+    def peekKidPages(self, kid, maxBytes=4096):
+        # kidPages from the kid's bytes in the file without parsing it, None unless it's an
+        # uncompressed object not parsed yet with one /Type /Page, or one /Type /Pages and one
+        # /Count, in its first maxBytes
+        if not isinstance(kid, IndirectObject) or self.cacheGetIndirectObject(kid.generation, kid.idnum) is not None:
+            return None
+        offset = self.xref.get(kid.generation, {}).get(kid.idnum)
+        if offset is None:
+            return None
+        end = self.mapped.find(b'endobj', offset, offset + maxBytes)
+        if end < 0:
+            return None
+        raw = self.mapped[offset:end]
+        header = OBJECT_HEADER.match(raw)
+        if header is None or int(header.group(1)) != kid.idnum:
+            return None
+        types = PAGE_TYPE.findall(raw)
+        if types == [b'Page']:
+            return 1
+        counts = PAGE_COUNT.findall(raw)
+        if types == [b'Pages'] and len(counts) == 1:
+            return int(counts[0])
+        return None
+
+    def rootPages(self):
+        return self.trailer['/Root'].getObject()['/Pages'].getObject()
+
+    def getNumPages(self):
+        if self.usePageTables() and self.pageTable(self.rootPages()) is not None:
+            return int(self.rootPages()['/Count'])
+        return PyPDF2.PdfFileReader.getNumPages(self)
+
+    def getPage(self, pageNumber):
+        if self.usePageTables():
+            pageObj = self.pageObjects.get(pageNumber)
+            if pageObj is None:
+                pageObj = self.lookupPage(pageNumber)
+            if pageObj is not None:
+                return pageObj
+        return PyPDF2.PdfFileReader.getPage(self, pageNumber)
+
+    def lookupPage(self, pageNumber):
+        # the page walked down to through the page tables, None if a node on the way doesn't add up
+        # or the page is past the root's /Count, where flattening the tree has the final say
+        if pageNumber < 0:
+            raise IndexError('page ' + str(pageNumber) + ' out of range')
+        if pageNumber >= self.getNumPages() or not self.usePageTables():
+            return None
+
+        node = self.rootPages()
+        inherit = {}
+        remaining = pageNumber
+        ref = None
+        while node.get('/Type', '/Pages') == '/Pages':
+            for attr in INHERITABLE_PAGE_ATTRIBUTES:
+                if attr in node:
+                    inherit[attr] = node[attr]
+            table = self.pageTable(node)
+            if table is None:
+                return None
+            _, starts, kids = table
+            # empty /Pages kids share their start with the next kid, bisect_right skips past them
+            kidIdx = bisect.bisect_right(starts, remaining) - 1
+            kid = kids[kidIdx]
+            remaining -= starts[kidIdx]
+            ref = kid if isinstance(kid, IndirectObject) else None
+            node = kid.getObject()
+
+        pageObj = PyPDF2.pdf.PageObject(self, ref)
+        pageObj.update(node)
+        for attr, value in inherit.items():
+            if attr not in pageObj:
+                pageObj[attr] = value
+        self.pageObjects[pageNumber] = pageObj
+        return pageObj
+
+    numPages = property(lambda self: self.getNumPages())
+
+def leadingLines(page, maxBytes=4096):
+    # (lines, complete) with the first lines of page.extractText(), from decoding at most maxBytes
+    # of the page's first content stream and cutting that back to a line break, so the text is
+    # exactly the start of the full text. Only whole lines are returned, a last line that may carry
+    # on further into the stream is left off, unless complete says the lines are all of the page's
+    # text. None when the start of the page can't be read that way.
+    contents = page.get('/Contents')
+    if contents is None:
+        return None
+    contents = contents.getObject()
+    complete = True
+    if isinstance(contents, ArrayObject):
+        if len(contents) == 0:
+            return None
+        complete = len(contents) == 1
+        contents = contents[0].getObject()
+    if not isinstance(contents, StreamObject):
+        return None
+
+    filters = contents.get('/Filter', ArrayObject())
+    if not isinstance(filters, ArrayObject):
+        filters = ArrayObject([filters])
+    if isinstance(contents, DecodedStreamObject) or len(filters) == 0:
+        data = contents._data[:maxBytes]
+        complete = complete and len(data) == len(contents._data)
+    elif len(filters) == 1 and filters[0] == '/FlateDecode' and '/DecodeParms' not in contents:
+        decompressor = zlib.decompressobj()
+        try:
+            data = decompressor.decompress(contents._data, maxBytes)
+        except zlib.error:
+            return None
+        complete = complete and decompressor.eof
+    else:
+        return None
+
+    if not complete:
+        cut = max(data.rfind(b'\n'), data.rfind(b'\r'))
+        if cut < 0:
+            return None
+        data = data[:cut + 1]
+    # PyPDF2 never gets to the end of an inline image that's been cut short
+    if re.search(rb'(^|\s)BI\s', data):
+        return None
+    stream = DecodedStreamObject()
+    stream.setData(data)
+    probe = PyPDF2.pdf.PageObject(page.pdf)
+    probe[NameObject('/Contents')] = stream
+    try:
+        text = probe.extractText()
+    except Exception:
+        # whatever PyPDF2 can't make of the cut down stream, the full extraction will deal with
+        return None
+    lines = text.split('\n')
+    return (lines, True) if complete else (lines[:-1], False)
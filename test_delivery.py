@@ -0,0 +1,155 @@
+import base64
+import threading
+import socketserver
+from functools import partial
+import pytest
+import delivery
+from delivery import SentLedger, SmtpPool, planDeliveries, deliver
+
+class StubSmtpHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        self.reply('220 stub ready')
+        recipients = []
+        for line in self.rfile:
+            command = line.decode().rstrip('\r\n')
+            verb = command.split(' ')[0].upper()
+            if verb == 'EHLO':
+                self.reply('250-stub')
+                self.reply('250 AUTH PLAIN')
+            elif verb == 'AUTH':
+                user = base64.b64decode(command.split(' ')[2]).split(b'\0')[1].decode()
+                with server.lock:
+                    server.logins.append(user)
+                self.reply(server.loginReply)
+            elif verb == 'MAIL':
+                recipients = []
+                self.reply('250 ok')
+            elif verb == 'RCPT':
+                recipients.append(command.split('<')[1].rstrip('>'))
+                self.reply('250 ok')
+            elif verb == 'DATA':
+                self.reply('354 go ahead')
+                data = b''
+                for dataLine in self.rfile:
+                    if dataLine == b'.\r\n':
+                        break
+                    data += dataLine
+                with server.lock:
+                    # the scripted replies are handed out in order, everything after them is accepted
+                    dataReply = server.dataReplies.pop(0) if len(server.dataReplies) > 0 else '250 queued'
+                    if dataReply.startswith('250'):
+                        server.messages.append((recipients, data))
+                self.reply(dataReply)
+            elif verb == 'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('250 ok')
+
+class StubSmtpServer(socketserver.ThreadingTCPServer):
+    # a local SMTP server that keeps every message it accepts, replies to the DATA of the first
+    # messages with dataReplies and to every login with loginReply
+    daemon_threads = True
+
+    def __init__(self, dataReplies=(), loginReply='235 ok'):
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), StubSmtpHandler)
+        self.lock = threading.Lock()
+        self.dataReplies = list(dataReplies)
+        self.loginReply = loginReply
+        self.connections = 0
+        self.logins = []
+        self.messages = []
+
+@pytest.fixture
+def smtpServer():
+    servers = []
+
+    def start(*args, **kwargs):
+        server = StubSmtpServer(*args, **kwargs)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+@pytest.fixture(autouse=True)
+def noBackoff(monkeypatch):
+    monkeypatch.setattr(delivery, 'sendDelivery', partial(delivery.sendDelivery, backoff=0))
+
+def writeOutputs(tmp_path, recipients):
+    # one small merged PDF stand in per (recipient, name), returned as planDeliveries outputs
+    outputs = []
+    for recipient, name in recipients:
+        path = tmp_path / name
+        path.write_bytes(b'%PDF-1.4\n% ' + name.encode() + b'\n')
+        outputs.append((recipient, str(path)))
+    return outputs
+
+def runDeliver(server, outputs, ledger, **poolArgs):
+    pool = SmtpPool('127.0.0.1', server.server_address[1], **poolArgs)
+    try:
+        deliveries, alreadySent = planDeliveries(outputs, ledger)
+        return deliveries, alreadySent, deliver(deliveries, pool, 'billing@example.com', ledger)
+    finally:
+        pool.close()
+
+def test_transient_reply_is_retried(tmp_path, smtpServer):
+    server = smtpServer(['451 try again later', '451 try again later'])
+    ledger = SentLedger(str(tmp_path / 'ledger.sqlite'))
+    outputs = writeOutputs(tmp_path, [('am@example.com', 'a.pdf')])
+    deliveries, alreadySent, failures = runDeliver(server, outputs, ledger)
+    assert failures == []
+    assert len(server.messages) == 1
+    assert server.messages[0][0] == ['am@example.com']
+    assert ledger.isSent('am@example.com', 'a.pdf')
+
+def test_permanent_reply_fails_without_retrying(tmp_path, smtpServer):
+    server = smtpServer(['550 mailbox unavailable'])
+    ledger = SentLedger(str(tmp_path / 'ledger.sqlite'))
+    outputs = writeOutputs(tmp_path, [('am@example.com', 'a.pdf')])
+    deliveries, alreadySent, failures = runDeliver(server, outputs, ledger)
+    assert len(failures) == 1
+    assert '550' in failures[0][1]
+    # the 550 used up the only scripted reply, a retry would have been accepted
+    assert server.messages == []
+    assert not ledger.isSent('am@example.com', 'a.pdf')
+
+def test_refused_login_opens_no_more_connections(tmp_path, smtpServer):
+    server = smtpServer(loginReply='535 authentication failed')
+    ledger = SentLedger(str(tmp_path / 'ledger.sqlite'))
+    outputs = writeOutputs(tmp_path, [('am' + str(amNum) + '@example.com', 'inv' + str(amNum) + '.pdf') for amNum in range(6)])
+    deliveries, alreadySent, failures = runDeliver(server, outputs, ledger, size=3, user='pgim', password='wrong')
+    assert len(failures) == 6
+    assert server.connections == 1
+    assert server.logins == ['pgim']
+    assert server.messages == []
+    assert all('535' in error for failedDelivery, error in failures)
+
+def test_rerun_skips_files_in_ledger(tmp_path, smtpServer):
+    server = smtpServer()
+    ledgerPath = str(tmp_path / 'ledger.sqlite')
+    outputs = writeOutputs(tmp_path, [('am1@example.com', 'a.pdf'), ('am1@example.com', 'b.pdf'), ('am2@example.com', 'c.pdf')])
+    ledger = SentLedger(ledgerPath)
+    deliveries, alreadySent, failures = runDeliver(server, outputs[:2], ledger)
+    ledger.close()
+    assert (len(deliveries), alreadySent, failures) == (1, 0, [])
+
+    # a new run with one more output only sends that one
+    ledger = SentLedger(ledgerPath)
+    deliveries, alreadySent, failures = runDeliver(server, outputs, ledger)
+    assert (len(deliveries), alreadySent, failures) == (1, 2, [])
+    assert deliveries[0].recipient == 'am2@example.com'
+    assert [recipients for recipients, data in server.messages] == [['am1@example.com'], ['am2@example.com']]
+
+    deliveries, alreadySent, failures = runDeliver(server, outputs, ledger)
+    assert (len(deliveries), alreadySent) == (0, 3)
+    assert len(server.messages) == 2
@@ -0,0 +1,94 @@
+import PyPDF2
+import pytest
+from sourcepdf import MappedPdfReader
+
+def writePageTree(fname, objects):
+    # objects maps object numbers to their dictionaries, pages named by a 'Name' get a content
+    # stream showing that name
+    pdf = bytearray(b'%PDF-1.4\n')
+    offsets = {}
+    streams = {}
+    for objNum, obj in sorted(objects.items()):
+        if '/Type /Page ' in obj and '/Name' in obj:
+            name = obj.split('/Name /')[1].split(' ')[0]
+            streams[100 + objNum] = ('BT /F1 10 Tf 40 760 Td (' + name + ') Tj ET').encode()
+            obj = obj.replace('>>', '/Contents ' + str(100 + objNum) + ' 0 R >>')
+        offsets[objNum] = len(pdf)
+        pdf += str(objNum).encode() + b' 0 obj\n' + obj.encode() + b'\nendobj\n'
+    for objNum, content in streams.items():
+        offsets[objNum] = len(pdf)
+        pdf += str(objNum).encode() + b' 0 obj\n<< /Length ' + str(len(content)).encode() + b' >>\nstream\n' + content + b'\nendstream\nendobj\n'
+    xrefOffset = len(pdf)
+    size = max(offsets) + 1
+    pdf += b'xref\n0 ' + str(size).encode() + b'\n'
+    for objNum in range(size):
+        pdf += ('%010d 00000 n \n' % offsets[objNum]).encode() if objNum in offsets else b'0000000000 65535 f \n'
+    pdf += b'trailer\n<< /Size ' + str(size).encode() + b' /Root 1 0 R >>\nstartxref\n' + str(xrefOffset).encode() + b'\n%%EOF\n'
+    with open(fname, 'wb') as hPdf:
+        hPdf.write(pdf)
+
+# an empty /Pages kid ahead of a page and a nested /Pages node, every /Count right
+EMPTY_KID_TREE = {
+    1: '<< /Type /Catalog /Pages 2 0 R >>',
+    2: '<< /Type /Pages /Count 3 /MediaBox [0 0 612 792] /Kids [3 0 R 4 0 R 5 0 R] >>',
+    3: '<< /Type /Pages /Count 0 /Kids [] /Parent 2 0 R >>',
+    4: '<< /Type /Page /Parent 2 0 R /Name /A >>',
+    5: '<< /Type /Pages /Count 2 /Kids [6 0 R 7 0 R] /Parent 2 0 R >>',
+    6: '<< /Type /Page /Parent 5 0 R /Name /B >>',
+    7: '<< /Type /Page /Parent 5 0 R /Name /C >>',
+}
+
+# the root claims 2 pages over 3
+SHORT_COUNT_TREE = {
+    1: '<< /Type /Catalog /Pages 2 0 R >>',
+    2: '<< /Type /Pages /Count 2 /MediaBox [0 0 612 792] /Kids [3 0 R 4 0 R 5 0 R] >>',
+    3: '<< /Type /Page /Parent 2 0 R /Name /A >>',
+    4: '<< /Type /Page /Parent 2 0 R /Name /B >>',
+    5: '<< /Type /Page /Parent 2 0 R /Name /C >>',
+}
+
+# the root adds up with its nested /Pages node's /Count, but that node claims 2 pages over 3
+NESTED_SHORT_COUNT_TREE = {
+    1: '<< /Type /Catalog /Pages 2 0 R >>',
+    2: '<< /Type /Pages /Count 3 /MediaBox [0 0 612 792] /Kids [3 0 R 4 0 R] >>',
+    3: '<< /Type /Page /Parent 2 0 R /Name /A >>',
+    4: '<< /Type /Pages /Count 2 /Kids [5 0 R 6 0 R 7 0 R] /Parent 2 0 R >>',
+    5: '<< /Type /Page /Parent 4 0 R /Name /B >>',
+    6: '<< /Type /Page /Parent 4 0 R /Name /C >>',
+    7: '<< /Type /Page /Parent 4 0 R /Name /D >>',
+}
+
+@pytest.mark.parametrize('objects', [EMPTY_KID_TREE, SHORT_COUNT_TREE])
+def test_pages_match_pdffilereader(tmp_path, objects):
+    fname = str(tmp_path / 'tree.pdf')
+    writePageTree(fname, objects)
+    expected = PyPDF2.PdfFileReader(fname)
+    with MappedPdfReader(fname) as reader:
+        assert reader.numPages == expected.numPages
+    # a fresh reader per page, as a worker starting mid document would have
+    for pageNum in range(expected.numPages):
+        with MappedPdfReader(fname) as reader:
+            page = reader.getPage(pageNum)
+            assert page.extractText() == expected.getPage(pageNum).extractText()
+            assert page.indirectRef.idnum == expected.getPage(pageNum).indirectRef.idnum
+
+def test_lookup_through_short_node_falls_back(tmp_path):
+    fname = str(tmp_path / 'tree.pdf')
+    writePageTree(fname, NESTED_SHORT_COUNT_TREE)
+    expected = PyPDF2.PdfFileReader(fname)
+    for pageNum in range(expected.numPages):
+        with MappedPdfReader(fname) as reader:
+            assert reader.getPage(pageNum).extractText() == expected.getPage(pageNum).extractText()
+            # only the lookups that went through the short node have to flatten the tree
+            assert (reader.flattenedPages is None) == (pageNum == 0)
+
+def test_lookup_only_reads_nodes_on_its_way(tmp_path):
+    fname = str(tmp_path / 'tree.pdf')
+    writePageTree(fname, EMPTY_KID_TREE)
+    with MappedPdfReader(fname) as reader:
+        reader.getPage(0)
+        assert len(reader.pageTables) == 1
+        # the root's kids are told apart from their bytes, the nested /Pages node isn't parsed
+        assert reader.cacheGetIndirectObject(0, 5) is None
+        reader.getPage(2)
+        assert len(reader.pageTables) == 2
@@ -1,80 +1,123 @@
 import os
 import sys
-import PyPDF2
 import platform
 import subprocess
-import pylightxl as xl
-from typing import List
 from pathlib import Path
-from fuzzywuzzy import fuzz
-from threading import Thread
+from threading import Event
 import multiprocessing as mp
-from functools import partial
-from scipy.optimize import fmin
-from dataclasses import dataclass
 from PyQt5 import QtWidgets, QtGui, QtCore, uic
-
-@dataclass
-class Invoice:
-    pageNum: int
-    projectName: str
-    projectNum: int
-    invoiceNum: int
-
-@dataclass
-class TimeDetail:
-    pages: List[int]
-    projectNum: int
-
-@dataclass
-class PairedData:
-    invoice: Invoice
-    timeDetail: TimeDetail
-
-def findPropertyNameEntryCandidates(db, pName, fuzzRatio):
-    candidates = []
-    for wsName in db.ws_names:
-        for rowNum, row in enumerate(db.ws(wsName).col(col=3)[2:]):
-            if fuzz.ratio(pName, row) >= fuzzRatio:
-                candidates.append(db.ws(wsName).row(rowNum + 3))
-    return candidates
-
-    bestFullMatch = 0
-    bestRatio = 0
-
-def maxFullAndPartial(fuzzRatio, db, pairedData):
-    partialMatched = 0
-    fullMatched = 0
-    noMatch = 0
-    fMatch = []
-    partialMatchCounts = []
-    pairCandidates = []
-    for pair in pairedData:
-        pName = pair.invoice.projectName
-        candidates = findPropertyNameEntryCandidates(db, pName, fuzzRatio)
-        if len(candidates) == 0:
-            for word in pName.split(' '):
-                if len(word) > 5:
-                    candidates += findPropertyNameEntryCandidates(db, word, fuzzRatio)
-        if len(candidates) > 1:
-            partialMatched += 1
-            partialMatchCounts.append(len(candidates))
-        elif len(candidates) == 1:
-            fullMatched += 1
-            fMatch.append((pair.invoice, candidates))
-        elif len(candidates) == 0:
-            noMatch += 1
-        pairCandidates.append((pair, candidates))
-        
-    try:
-        fullMatchRatio = fullMatched / len(pairedData)
-        partialMatchRatio = partialMatched / len(pairedData)
-        partialMatchAvg = sum(partialMatchCounts) / len(partialMatchCounts)
-        retStr = 'Partial match for ' + str(int(partialMatchRatio * 100)) + '% with avg. count ' + str(int(partialMatchAvg)) + '. Min: ' + str(min(partialMatchCounts)) + ', Max: ' + str(max(partialMatchCounts)) + '\nFull match for ' + str(int(fullMatchRatio * 100)) + '%' + '\nNo match for ' + str(int(noMatch / len(pairedData) * 100)) + '%'
+from metrics import Metrics
+from pagecache import PageCache
+from outputmanifest import OutputManifest
+from pgim import PARSER_VERSION, PairingReport, loadPropertyNameIndex, MatchScores, sweepThresholds, maxFullAndPartial, describePairing, streamMergePairs
+
+def matchDetails(pairCandidates):
+    # the analysis summary shown in the window, from pgim.maxFullAndPartial's candidates, which are
+    # None when nothing matched partially
+    if pairCandidates is None:
+        return ''
+    counts = [len(candidates) for pair, candidates in pairCandidates]
+    partialMatchCounts = [count for count in counts if count > 1]
+    fullMatchRatio = counts.count(1) / len(counts)
+    partialMatchRatio = len(partialMatchCounts) / len(counts)
+    partialMatchAvg = sum(partialMatchCounts) / len(partialMatchCounts)
+    return 'Partial match for ' + str(int(partialMatchRatio * 100)) + '% with avg. count ' + str(int(partialMatchAvg)) + '. Min: ' + str(min(partialMatchCounts)) + ', Max: ' + str(max(partialMatchCounts)) + '\nFull match for ' + str(int(fullMatchRatio * 100)) + '%' + '\nNo match for ' + str(int(counts.count(0) / len(counts) * 100)) + '%'
+
+class Cancelled(Exception):
+    pass
+
+class PipelineWorker(QtCore.QObject):
+    # Runs parsing, pairing, merging and the analysis off the Qt main thread. Everything it has to
+    # tell the window goes through signals, and cancel() is checked between pages and pairs.
+    progress = QtCore.pyqtSignal(int)
+    status = QtCore.pyqtSignal(str)
+    finished = QtCore.pyqtSignal(str)
+    cancelled = QtCore.pyqtSignal()
+    failed = QtCore.pyqtSignal(str)
+
+    def __init__(self, invoicePath, timeDetailPath, assetAssignmentsPath, outputFolderPath, processes, pageCache, analysisGranularity, metricsPath):
+        super(PipelineWorker, self).__init__()
+        self.invoicePath = invoicePath
+        self.timeDetailPath = timeDetailPath
+        self.assetAssignmentsPath = assetAssignmentsPath
+        self.outputFolderPath = outputFolderPath
+        self.processes = processes
+        self.pageCache = pageCache
+        self.analysisGranularity = analysisGranularity
+        self.metricsPath = metricsPath
+        self.cancelRequested = Event()
+        self.lastProgress = -1
+
+    def cancel(self):
+        # called straight from the main thread, run() is busy so a queued slot would never get to run
+        self.cancelRequested.set()
+
+    def checkCancelled(self):
+        if self.cancelRequested.is_set():
+            raise Cancelled()
+
+    def run(self):
+        try:
+            self.metrics = Metrics()
+            with self.metrics.stage('streamMergePairs') as stage:
+                self.pairedData = self.streamPairs(stage)
+
+            self.status.emit('Running statistical analysis...')
+            with self.metrics.stage('loadAssetAssignments') as stage:
+                self.assetIndex = loadPropertyNameIndex(self.assetAssignmentsPath)
+                stage.items = len(self.assetIndex.names)
+            self.checkCancelled()
+
+            pairCandidates = list()
+            with self.metrics.stage('statisticalAnalysis') as stage:
+                self.statisticalAnalysis(self.assetIndex, self.pairedData, pairCandidates)
+                stage.items = len(self.pairedData)
+            self.metrics.export(self.metricsPath)
+            self.pairCandidatesList = pairCandidates[:-1]
+            details = pairCandidates[len(pairCandidates) - 1]
+            if len(describePairing(self.pairingReport)) > 0:
+                details += '\n\nInvoices without time detail: ' + str(len(self.pairingReport.unmatchedInvoices)) + '\nTime details without invoice: ' + str(len(self.pairingReport.orphanTimeDetails)) + '\nDuplicate time detail project numbers: ' + str(len(self.pairingReport.duplicateTimeDetails)) + '\nUnreadable pages: ' + str(len(self.pairingReport.pageFailures))
+            self.finished.emit(details)
+        except Cancelled:
+            self.cancelled.emit()
+        except Exception as e:
+            self.failed.emit(str(e))
+
+    def updateProgress(self, done, total):
+        # called for every page read, so this is where a cancel between pages is picked up
+        self.checkCancelled()
+        percent = int(done / total * 100)
+        if percent != self.lastProgress:
+            self.lastProgress = percent
+            self.progress.emit(percent)
+
+    def streamPairs(self, stage):
+        self.status.emit('Parsing, pairing and merging ' + self.invoicePath + ' and ' + self.timeDetailPath + '...')
+        self.pairingReport = PairingReport([], [], {}, [])
+        manifest = OutputManifest(self.outputFolderPath, self.invoicePath, self.timeDetailPath)
+        for pair in streamMergePairs(self.invoicePath, self.timeDetailPath, self.outputFolderPath, self.pairingReport, self.processes, self.pageCache, self.updateProgress, stage, manifest):
+            self.checkCancelled()
+        for line in describePairing(self.pairingReport):
+            print(line)
+        self.progress.emit(100)
+        return self.pairingReport.pairs
+
+    def statisticalAnalysis(self, indexD, pairedDataD, outputList):
+        print('Running statistical analysis...')
+        fuzzRatios = range(30, 71, self.analysisGranularity)
+        scores = MatchScores(indexD, pairedDataD, min(fuzzRatios))
+        self.checkCancelled()
+        results = sweepThresholds(scores, fuzzRatios)
+        bestPair = (0, 0)
         
-        return (fuzzRatio, fullMatched, pairCandidates, retStr)
-    except:
-        return (0, 0, None, '')
+        for r in results:
+            if bestPair[1] < r[1]:
+                bestPair = r
+
+        print('Best ratio: ' + str(bestPair[0]))
+        final = maxFullAndPartial(bestPair[0], scores, dbg=False)
+        outputList.append(final[2])
+        outputList.append(matchDetails(final[2]))
 
 class UI(QtWidgets.QMainWindow):
     def __init__(self):
@@ -88,10 +131,15 @@ class UI(QtWidgets.QMainWindow):
         self.assetAssignmentsButton.clicked.connect(self.browseAssetAssignments)
         self.outputButton.clicked.connect(self.browseOutputFolder)
         self.executeButton.clicked.connect(self.execute)
+        self.cancelButton.clicked.connect(self.cancel)
         self.openOutputButton.clicked.connect(self.openOutput)
         self.progressBar.setValue(0)
         self.openOutputButton.setEnabled(False)
-        self.analysisGranularity = 5
+        self.analysisGranularity = 1
+        self.processes = mp.cpu_count()
+        self.pageCache = PageCache('page_cache.sqlite', PARSER_VERSION)
+        self.metricsPath = 'metrics.json'
+        self.workerThread = None
 
         self.invoicePath = 'C:/Users/Connor/Documents/Programming/Python/PGIM/invoices.pdf'
         self.timeDetailPath = 'C:/Users/Connor/Documents/Programming/Python/PGIM/time_detail.pdf'
@@ -122,22 +170,62 @@ class UI(QtWidgets.QMainWindow):
             QtWidgets.QMessageBox().critical(self, 'Error', 'Output directory ' + self.outputText.text() + ' does not exist')
             return
         
-        self.invoices = self.extractInvoices()
-        self.timeDetail = self.extractTimeDetail()
-        self.pairedData = self.pairData()
-        self.mergePairs()
-
-        self.statusBar.showMessage('Running statistical analysis...')
-        self.db = xl.readxl(fn=self.assetAssignmentText.text())
-        
-        pairCandidates = list()
-        self.statisticalAnalysis(self.db, self.pairedData, pairCandidates)
-        pairCandidatesList = pairCandidates[:-1]
-        QtWidgets.QMessageBox().information(self, 'Analysis details', pairCandidates[len(pairCandidates) - 1])
+        self.progressBar.setValue(0)
+        self.openOutputButton.setEnabled(False)
+        self.executeButton.setEnabled(False)
+        self.cancelButton.setEnabled(True)
+
+        self.worker = PipelineWorker(self.invoiceText.text(), self.timeDetailText.text(), self.assetAssignmentText.text(), self.outputText.text(), self.processes, self.pageCache, self.analysisGranularity, self.metricsPath)
+        self.workerThread = QtCore.QThread()
+        self.worker.moveToThread(self.workerThread)
+        self.workerThread.started.connect(self.worker.run)
+        self.worker.progress.connect(self.progressBar.setValue)
+        self.worker.status.connect(self.statusBar.showMessage)
+        self.worker.finished.connect(self.pipelineFinished)
+        self.worker.cancelled.connect(self.pipelineCancelled)
+        self.worker.failed.connect(self.pipelineFailed)
+        self.workerThread.start()
+
+    def cancel(self):
+        self.cancelButton.setEnabled(False)
+        self.statusBar.showMessage('Cancelling...')
+        self.worker.cancel()
+
+    def stopWorker(self):
+        self.workerThread.quit()
+        self.workerThread.wait()
+        self.workerThread = None
+        self.executeButton.setEnabled(True)
+        self.cancelButton.setEnabled(False)
+
+    def pipelineFinished(self, details):
+        self.stopWorker()
+        self.pairedData = self.worker.pairedData
+        self.pairingReport = self.worker.pairingReport
+        self.assetIndex = self.worker.assetIndex
+        QtWidgets.QMessageBox().information(self, 'Analysis details', details)
 
         self.openOutputButton.setEnabled(True)
         self.statusBar.showMessage('Done. I love you Mom!')
 
+    def pipelineCancelled(self):
+        self.stopWorker()
+        # pairs already merged stay in the output folder
+        self.openOutputButton.setEnabled(True)
+        self.statusBar.showMessage('Cancelled.')
+
+    def pipelineFailed(self, message):
+        self.stopWorker()
+        self.statusBar.showMessage('Failed.')
+        QtWidgets.QMessageBox().critical(self, 'Error', message)
+
+    def closeEvent(self, event):
+        if self.workerThread is not None:
+            self.worker.cancel()
+            self.workerThread.quit()
+            self.workerThread.wait()
+        event.accept()
+
     def openOutput(self):
         if platform.system() == 'Windows':
             os.startfile(self.outputText.text())
@@ -160,120 +248,6 @@ class UI(QtWidgets.QMainWindow):
         self.outputFolderPath = QtWidgets.QFileDialog.getExistingDirectory(self, 'Select Folder')
         self.outputText.setText(self.outputFolderPath)
 
-    def extractInvoices(self):
-        parsedInvoices = []
-        hInvoices = open(self.invoicePath, 'rb')
-        invoicesReader = PyPDF2.PdfFileReader(hInvoices)
-        self.statusBar.showMessage('Parsing invoices from ' + self.invoicePath + '...')
-        
-        for pageNum in range(invoicesReader.numPages):
-            self.progressBar.setValue(int(pageNum / invoicesReader.numPages * 100))
-            invoicesZ = invoicesReader.getPage(pageNum)
-            lines = invoicesZ.extractText().split('\n')
-            invoiceNum = lines[lines.index('Invoice No.') + 1]
-            pNameNum = lines[lines.index('Project No.') + 1]
-            pName = ' '.join(pNameNum.split(' ')[1:])
-            pNum = pNameNum.split(' ')[0]
-            parsedInvoices.append(Invoice(pageNum, pName, pNum, invoiceNum))
-
-        self.progressBar.setValue(100)
-        hInvoices.close()
-        return parsedInvoices
-
-    def extractTimeDetail(self):
-        hTimeDetail = open(self.timeDetailPath, 'rb')
-        timeDetailReader = PyPDF2.PdfFileReader(hTimeDetail)
-        timeDetails = []
-        self.statusBar.showMessage('Parsing time detail from ' + self.timeDetailPath + '...')
-
-        for pageNum in range(timeDetailReader.numPages):
-            self.progressBar.setValue(int(pageNum / timeDetailReader.numPages * 100))
-            td0 = timeDetailReader.getPage(pageNum)
-            lines = td0.extractText().split('\n')
-            
-            notesIdx = lines.index('Notes')
-            onNewPage = lines[notesIdx + 1].split(' ')[0] == 'PGIM'
-            
-            if onNewPage:
-                pNum = lines[notesIdx + 1]
-                nameDetails = pNum.split(':')[1].split(' ')
-                if nameDetails[1] == 'PK':
-                    pNamePrefix = lines[notesIdx+1].split(':')[2]
-                    pNameSuffix = lines[notesIdx+2]
-                    middleChar = pNamePrefix[len(pNamePrefix) - 1]
-                    if str.isalpha(middleChar):
-                        pName = pNamePrefix[:-2]
-                    elif middleChar == ' ':
-                        pName = pNamePrefix.strip()
-                    else: # pNamePrefix last char is '.' or numeric
-                        specialIdx = 0
-                        pName = pNamePrefix
-                        while pNameSuffix[specialIdx] == '.' or str.isnumeric(pNameSuffix[specialIdx]):
-                            pName += pNameSuffix[specialIdx]
-                            specialIdx += 1
-                else:
-                    pName = nameDetails[0]
-                timeDetail = TimeDetail([pageNum], pName)
-                timeDetails.append(timeDetail)
-            else:
-                timeDetails[len(timeDetails) - 1].pages.append(pageNum)
- 
-        self.progressBar.setValue(100)
-        hTimeDetail.close()
-        return timeDetails
-
-    def pairData(self):
-        pairedData = []
-        self.statusBar.showMessage('Pairing invoices and time details...')
-
-        for i, inv in enumerate(self.invoices):
-            self.progressBar.setValue(int(i / len(self.invoices) * 100))
-            pairedTimeDetail = None
-            for td in self.timeDetail:
-                if inv.projectNum == td.projectNum:
-                    pairedTimeDetail = td
-            if pairedTimeDetail == None:
-                print('Couldn\'t find matching time detail for invoice!')
-                print('Page ' + str(inv.pageNum + 1) + ': Invoice ' + inv.invoiceNum + ' for ' + inv.projectNum + ' ' + inv.projectName)
-            else:
-                pairedData.append(PairedData(inv, pairedTimeDetail))
-
-        self.progressBar.setValue(100)
-        return pairedData
-
-    def mergePairs(self):
-        invoiceReader = PyPDF2.PdfFileReader(self.invoicePath)
-        timeDetailReader = PyPDF2.PdfFileReader(self.timeDetailPath)
-        
-        self.statusBar.showMessage('Merging pairs to disk...')
-        for i, pair in enumerate(self.pairedData):
-            self.progressBar.setValue(int(i / len(self.pairedData) * 100))
-            invoicePage = pair.invoice.pageNum
-            timeDetailPages = pair.timeDetail.pages
-            pdfWriter = PyPDF2.PdfFileWriter()
-            pdfWriter.addPage(invoiceReader.getPage(invoicePage))
-        
-            for p in timeDetailPages:
-                pdfWriter.addPage(timeDetailReader.getPage(p))
-            with Path(self.outputFolderPath + '/ASM_AN_' + pair.invoice.projectNum + '_' + pair.invoice.projectName.replace('\\', '.').replace('/', '.') + '_' + str(pair.invoice.invoiceNum) + '.pdf').open('wb') as outputFile:
-                pdfWriter.write(outputFile)
-        self.progressBar.setValue(100)
-
-    def statisticalAnalysis(self, dbD, pairedDataD, outputList):
-        print('Running statistical analysis...')
-        pool = mp.Pool(processes=16)
-        results = pool.map(partial(maxFullAndPartial, db=dbD, pairedData=pairedDataD), range(30, 72, self.analysisGranularity))
-        bestPair = (0, 0)
-        
-        for r in results:
-            if bestPair[1] < r[1]:
-                bestPair = r
-
-        print('Best ratio: ' + str(bestPair[0]))
-        final = maxFullAndPartial(bestPair[0], db=dbD, pairedData=pairedDataD)
-        outputList.append(final[2])
-        outputList.append(final[3])
-
 if __name__ == '__main__':
     app = QtWidgets.QApplication(sys.argv)
     window = UI()
@@ -0,0 +1,51 @@
+import os
+import json
+import struct
+import numpy as np
+
+SNAPSHOT_MAGIC = b'PGIMWB1\n'
+
+def snapshotPath(workbookFname):
+    return workbookFname + '.snapshot'
+
+def writeSnapshot(path, workbookHash, names, rows, alphabet, arrays):
+    # Magic, the length of a JSON header, the header (workbook hash, property names, row references,
+    # alphabet and where each array starts) and then the raw arrays, each 8 byte aligned so
+    # readSnapshot can map them straight from the file
+    header = {'workbookHash': workbookHash, 'names': names, 'rows': rows, 'alphabet': alphabet, 'arrays': {}}
+    offset = 0
+    for name, array in arrays.items():
+        header['arrays'][name] = [array.dtype.str, list(array.shape), offset]
+        offset += -(-array.nbytes // 8) * 8
+    headerBytes = json.dumps(header).encode()
+    headerBytes += b' ' * (-(len(SNAPSHOT_MAGIC) + 8 + len(headerBytes)) % 8)
+
+    tmpPath = path + '.tmp'
+    with open(tmpPath, 'wb') as hSnapshot:
+        hSnapshot.write(SNAPSHOT_MAGIC + struct.pack('<Q', len(headerBytes)) + headerBytes)
+        for array in arrays.values():
+            data = np.ascontiguousarray(array).tobytes()
+            hSnapshot.write(data + b'\0' * (-len(data) % 8))
+    os.replace(tmpPath, path)
+
+def readSnapshot(path, workbookHash):
+    # returns (names, rows, alphabet, arrays) or None if there's no snapshot for this workbook hash.
+    # The arrays are read only memmaps, so processes opening the same snapshot share its pages.
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'rb') as hSnapshot:
+        if hSnapshot.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+            return None
+        headerLength = struct.unpack('<Q', hSnapshot.read(8))[0]
+        header = json.loads(hSnapshot.read(headerLength))
+    if header['workbookHash'] != workbookHash:
+        return None
+
+    dataStart = len(SNAPSHOT_MAGIC) + 8 + headerLength
+    arrays = {}
+    for name, (dtype, shape, offset) in header['arrays'].items():
+        if np.prod(shape) == 0:
+            arrays[name] = np.zeros(shape, dtype=dtype)
+        else:
+            arrays[name] = np.memmap(path, dtype=dtype, mode='r', offset=dataStart + offset, shape=tuple(shape))
+    return header['names'], [tuple(row) for row in header['rows']], header['alphabet'], arrays